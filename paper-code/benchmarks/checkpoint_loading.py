@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Compares how long it takes to restore a checkpoint in the memory-mapped format of
+checkpoint.py and as a torch.save pickle.
+
+Saves the training state of a Cifar model (parameters, buffers, momenta and error feedback
+memory) both ways, and times loading all of it, and loading only the model for evaluation.
+Every loaded tensor is summed, so the times include reading the data. Drop the page cache
+between runs (or use a large model) to measure cold reads from disk.
+
+Run it from the paper-code directory:
+    python -m benchmarks.checkpoint_loading
+"""
+
+import os
+import tempfile
+import time
+
+import torch
+
+from checkpoint import AsyncCheckpointer, load_checkpoint, load_model_state
+from tasks import cifar_architectures
+
+config = dict(
+    task_architecture="ResNet18",
+    num_repetitions=5,
+)
+
+
+def main():
+    model = getattr(cifar_architectures, config["task_architecture"])()
+    parameter_names = {name for name, _ in model.named_parameters()}
+    shared_state = {}
+    worker_state = {"model_buffers": {}, "memories": []}
+    for name, value in model.state_dict().items():
+        if name in parameter_names:
+            shared_state["model." + name] = value
+            shared_state["momentum." + name] = torch.randn_like(value)
+            worker_state["memories"].append(torch.randn_like(value))
+        else:
+            worker_state["model_buffers"][name] = value
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpointer = AsyncCheckpointer(rank=0, n_workers=1)
+        checkpointer.save(directory, shared_state, worker_state)
+        checkpointer.close()
+
+        pickle_path = os.path.join(directory, "checkpoint.pt")
+        torch.save({"shared": shared_state, "worker": worker_state}, pickle_path)
+
+        loaders = {
+            "torch.load, everything": lambda: torch.load(pickle_path),
+            "torch.load, model only": lambda: model_entries(torch.load(pickle_path)["shared"]),
+            "mmap, everything": lambda: load_checkpoint(directory, rank=0),
+            "mmap, model only": lambda: load_model_state(directory),
+        }
+        for name, load in loaders.items():
+            durations = []
+            for _ in range(config["num_repetitions"]):
+                start = time.perf_counter()
+                touch(load())
+                durations.append(time.perf_counter() - start)
+            print(f"{name:25s} | {1e3 * min(durations):8.1f} ms")
+
+
+def model_entries(shared_state):
+    return {name: value for name, value in shared_state.items() if name.startswith("model.")}
+
+
+def touch(state):
+    """Sum all tensors, so that they are actually read"""
+    if isinstance(state, dict):
+        state = list(state.values())
+    if isinstance(state, (list, tuple)):
+        for entry in state:
+            touch(entry)
+    elif isinstance(state, torch.Tensor):
+        state.float().sum()
+
+
+if __name__ == "__main__":
+    main()
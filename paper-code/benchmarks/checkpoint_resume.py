@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+Checks that training resumed from a checkpoint is bit-identical to uninterrupted training.
+
+Runs train.py on one worker for `num_epochs` short epochs with checkpoints after the first
+and the last epoch. Then runs it again, resumed from the first checkpoint, and compares
+the final checkpoints: model, momenta, error feedback memory, reducer state and random
+number generators must be exactly equal. Every run has its own process, so no state
+carries over between them.
+
+Run it from the paper-code directory:
+    python -m benchmarks.checkpoint_resume
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+from checkpoint import load_checkpoint
+
+config = dict(
+    num_epochs=3,
+    num_batches_per_epoch=20,
+    train_config=dict(
+        n_workers=1,
+        rank=0,
+        task="Cifar",
+        task_architecture="ResNet18",
+        optimizer_reducer="RankKReducer",
+        optimizer_reducer_rank=2,
+        log_verbosity=0,
+    ),
+)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as output_dir:
+        last_epoch = config["num_epochs"] - 1
+        uninterrupted = os.path.join(output_dir, "uninterrupted")
+        resumed = os.path.join(output_dir, "resumed")
+        run(uninterrupted, checkpoints=[0, last_epoch])
+        run(
+            resumed,
+            checkpoints=[last_epoch],
+            resume_from=os.path.join(uninterrupted, "epoch_000"),
+        )
+
+        final_checkpoint = "epoch_{:03d}".format(last_epoch)
+        _, *expected = load_checkpoint(os.path.join(uninterrupted, final_checkpoint), rank=0)
+        _, *actual = load_checkpoint(os.path.join(resumed, final_checkpoint), rank=0)
+        differences = list(compare(expected, actual))
+
+    for path in differences:
+        print(f"FAIL: {path} differs after resuming")
+    if differences:
+        sys.exit(1)
+    print("OK")
+
+
+def run(output_dir, **overrides):
+    train_config = {**config["train_config"], "num_epochs": config["num_epochs"], **overrides}
+    subprocess.run(
+        [sys.executable, "-m", "benchmarks.checkpoint_resume", "--child", output_dir],
+        input=json.dumps(train_config).encode(),
+        check=True,
+    )
+
+
+def child(output_dir):
+    import train
+
+    build_task = train.tasks.build
+
+    def build_short_epoch_task(*args, **kwargs):
+        return ShortEpochs(build_task(*args, **kwargs), config["num_batches_per_epoch"])
+
+    os.makedirs(output_dir)
+    train.output_dir = output_dir
+    train.config.update(json.loads(sys.stdin.read()))
+    train.tasks.build = build_short_epoch_task
+    train.log_metric = lambda *args, **kwargs: None
+    train.main()
+
+
+class ShortEpochs:
+    """A task whose training epochs only have the first `num_batches` batches"""
+
+    def __init__(self, task, num_batches):
+        self._task = task
+        self._num_batches = num_batches
+
+    def __getattr__(self, name):
+        return getattr(self._task, name)
+
+    def train_iterator(self, batch_size):
+        return FirstBatches(self._task.train_iterator(batch_size), self._num_batches)
+
+
+class FirstBatches:
+    def __init__(self, loader, num_batches):
+        self._loader = loader
+        self._num_batches = min(num_batches, len(loader))
+
+    def __len__(self):
+        return self._num_batches
+
+    def __iter__(self):
+        for i, batch in enumerate(self._loader):
+            if i == self._num_batches:
+                break
+            yield batch
+
+
+def compare(expected, actual, path="checkpoint"):
+    """Yields the paths of entries that are not exactly equal"""
+    if isinstance(expected, dict):
+        if expected.keys() != actual.keys():
+            yield path
+            return
+        for key in expected:
+            yield from compare(expected[key], actual[key], f"{path}.{key}")
+    elif isinstance(expected, (list, tuple)):
+        if len(expected) != len(actual):
+            yield path
+            return
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            yield from compare(e, a, f"{path}[{i}]")
+    elif isinstance(expected, torch.Tensor):
+        if not torch.equal(expected, actual):
+            yield path
+    elif isinstance(expected, np.ndarray):
+        if not np.array_equal(expected, actual):
+            yield path
+    elif expected != actual:
+        yield path
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        child(sys.argv[-1])
+    else:
+        main()
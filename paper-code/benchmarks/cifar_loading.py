@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+Compares the throughput of the Cifar training data pipelines.
+
+Iterates over `num_batches` training batches of CifarTask with the per-sample
+torchvision transforms, and with the memory-mapped dataset that augments whole
+batches at once, and reports samples per second.
+
+Run it from the paper-code directory:
+    python -m benchmarks.cifar_loading
+"""
+
+import datetime
+import time
+
+import torch
+import torch.distributed as dist
+
+import tasks
+from benchmarks.reducers import host_store
+from timer import Timer
+
+config = dict(
+    distributed_backend="gloo",
+    device="cpu",
+    task="Cifar",
+    task_architecture="ResNet18",
+    datasets=["torchvision", "mmap"],
+    optimizer_batch_size=128,
+    num_batches=200,
+    num_warmup_batches=10,
+    seed=42,
+)
+
+
+def main():
+    dist.init_process_group(
+        backend=config["distributed_backend"],
+        store=host_store(),
+        timeout=datetime.timedelta(seconds=120),
+        world_size=1,
+        rank=0,
+    )
+
+    for dataset in config["datasets"]:
+        samples_per_second = measure(dataset)
+        print(f"{dataset:12s} | {samples_per_second:10.0f} samples/s")
+
+    dist.destroy_process_group()
+
+
+def measure(dataset):
+    device = torch.device(config["device"])
+    timer = Timer(verbosity_level=1, log_fn=lambda *args, **kwargs: None)
+    task_config = {**config, "device": device, "task_cifar_dataset": dataset}
+    task = tasks.build(task_name=config["task"], timer=timer, **task_config)
+
+    num_samples = 0
+    for i, batch in enumerate(task.train_iterator(config["optimizer_batch_size"])):
+        if i == config["num_warmup_batches"]:
+            # Don't count starting the data loader workers and filling the page cache
+            start = time.perf_counter()
+        elif i > config["num_warmup_batches"]:
+            num_samples += len(batch.y)
+        if i == config["num_warmup_batches"] + config["num_batches"]:
+            break
+    return num_samples / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+Sanity check that storing the error feedback memory in low precision does not hurt convergence.
+
+Trains the Cifar task on a single worker with a compressing reducer, once with a
+full-precision memory and once for each low-precision `optimizer_memory_dtype`,
+and compares the training loss at the end.
+
+Run it from the paper-code directory:
+    python -m benchmarks.memory_dtype_convergence
+"""
+
+import datetime
+import sys
+
+import torch
+import torch.distributed as dist
+
+import gradient_reducers
+import tasks
+from benchmarks.reducers import host_store
+from powersgd.error_feedback import ErrorFeedbackBuffer
+from timer import Timer
+
+config = dict(
+    distributed_backend="gloo",
+    device="cpu",
+    task="Cifar",
+    task_architecture="ResNet18",
+    memory_dtypes=[None, "bfloat16", "float16", "int8"],
+    num_batches=400,
+    num_averaged_batches=50,  # the loss is averaged over the final batches
+    optimizer_batch_size=128,
+    optimizer_learning_rate=0.1,
+    optimizer_momentum=0.9,
+    optimizer_reducer="RankKReducer",
+    optimizer_reducer_rank=2,
+    optimizer_reducer_reuse_query=True,
+    optimizer_reducer_n_power_iterations=0,
+    seed=42,
+    max_relative_loss_increase=0.1,
+)
+
+
+def main():
+    dist.init_process_group(
+        backend=config["distributed_backend"],
+        store=host_store(),
+        timeout=datetime.timedelta(seconds=120),
+        world_size=1,
+        rank=0,
+    )
+
+    final_losses = {}
+    for memory_dtype in config["memory_dtypes"]:
+        final_losses[memory_dtype] = train(memory_dtype)
+        print(f"optimizer_memory_dtype={memory_dtype}: final loss {final_losses[memory_dtype]:.4f}")
+
+    reference = final_losses[None]
+    failed = False
+    for memory_dtype, loss in final_losses.items():
+        relative_increase = (loss - reference) / reference
+        if relative_increase > config["max_relative_loss_increase"]:
+            print(f"FAIL: {memory_dtype} loss is {100 * relative_increase:.1f}% above full precision")
+            failed = True
+
+    dist.destroy_process_group()
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+
+def train(memory_dtype):
+    torch.manual_seed(config["seed"])
+    device = torch.device(config["device"])
+    timer = Timer(verbosity_level=1, log_fn=lambda *args, **kwargs: None)
+
+    task = tasks.build(task_name=config["task"], timer=timer, **{**config, "device": device})
+    reducer = gradient_reducers.build_reducer(config["optimizer_reducer"], config, device, timer)
+
+    memories = [torch.zeros_like(param) for param in task.state]
+    momenta = [torch.zeros_like(param) for param in task.state]
+    memory_buffer = None
+    if memory_dtype is not None:
+        memory_buffer = ErrorFeedbackBuffer(task.state, memory_dtype, seed=config["seed"])
+    else:
+        send_buffers = [torch.zeros_like(param) for param in task.state]
+
+    losses = []
+    while len(losses) < config["num_batches"]:
+        for batch in task.train_iterator(config["optimizer_batch_size"]):
+            loss, grads, _ = task.batch_loss_and_gradient(batch)
+            losses.append(loss.item())
+
+            if memory_buffer is not None:
+                # In place, as in train.py
+                memory_buffer.add_to(grads, out=memories)
+                reducer.reduce(memories, grads, memories)
+                memory_buffer.store(memories)
+            else:
+                for grad, memory, send_bfr in zip(grads, memories, send_buffers):
+                    torch.add(grad, memory, out=send_bfr)
+                reducer.reduce(send_buffers, grads, memories)
+
+            for param, grad, momentum in zip(task.state, grads, momenta):
+                momentum.mul_(config["optimizer_momentum"]).add_(grad)
+                # Nesterov momentum
+                param.data.add_(
+                    grad + config["optimizer_momentum"] * momentum,
+                    alpha=-config["optimizer_learning_rate"],
+                )
+
+            if len(losses) >= config["num_batches"]:
+                break
+
+    final_losses = losses[-config["num_averaged_batches"] :]
+    return sum(final_losses) / len(final_losses)
+
+
+if __name__ == "__main__":
+    main()
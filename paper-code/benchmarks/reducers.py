@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+"""
+Measures gradient reducers in isolation, on synthetic gradients.
+
+For every combination of world size, model and reducer, this spawns `n_workers` gloo
+workers on localhost that feed random gradients with the parameter shapes of the model
+through the reducer. It reports the time per phase (the Timer labels used inside the
+reducers), bytes communicated, peak memory and the error relative to the exact average.
+The peak memory is what the reducer allocates on top of the gradients and buffers.
+On CPU, it is measured with the peak resident set size of Linux.
+
+Run it from the paper-code directory:
+    python -m benchmarks.reducers
+"""
+
+import datetime
+import json
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import gradient_reducers
+from tasks import cifar_architectures
+from timer import Timer
+
+try:
+    import powersgd
+    from powersgd.communication import CommunicationLog
+except ImportError:  # also for upstream powersgd, which does not count its communication
+    powersgd = None
+
+config = dict(
+    distributed_backend="gloo",
+    device="cpu",
+    n_workers=[1, 4],
+    models=[
+        "ResNet18",
+        "PreActResNet18",
+        "vgg16",
+        "GoogLeNet",
+        "DenseNet121",
+        "ResNeXt29_2x64d",
+        "MobileNet",
+        "MobileNetV2",
+        "DPN26",
+        "ShuffleNetG2",
+        "SENet18",
+        "PNASNetB",
+        "LeNet",
+        "LSTM",
+    ],
+    reducers=None,  # None means: all registered reducers and powersgd aggregators
+    # Only registered reducers with all of these capabilities, e.g. ["all_reduce_compatible"]
+    # or ["supports_async"]. The powersgd aggregators both use all-reduce and are synchronous.
+    reducer_capabilities=[],
+    warmup_repetitions=1,  # not counted in the times, bytes and errors
+    repetitions=10,
+    seed=42,
+    optimizer_reducer_rank=2,
+    optimizer_reducer_reuse_query=True,
+    optimizer_reducer_n_power_iterations=0,
+    optimizer_reducer_compression=1 / 244,
+    powersgd_num_iters_per_step=2,
+    powersgd_min_compression_rate=2,
+    lstm_vocab_size=33278,  # WikiText-2
+)
+
+output_dir = "./output.tmp"  # will be overwritten by run.py
+
+# These reducers need the optional bit2byte extension
+BIT2BYTE_REDUCERS = ["SignAndNormReducer", "SignReducer", "SignSGDwithMajorityVoteReducer"]
+POWERSGD_AGGREGATORS = ["powersgd.AllReduce", "powersgd.PowerSGD"]
+
+
+def main():
+    reducers = config["reducers"] if config["reducers"] is not None else available_reducers()
+
+    results = []
+    for n_workers in config["n_workers"]:
+        for model_name in config["models"]:
+            for reducer_name in reducers:
+                queue = mp.get_context("spawn").SimpleQueue()
+                store = host_store()
+                mp.spawn(
+                    benchmark_worker,
+                    args=(n_workers, store.port, model_name, reducer_name, config, queue),
+                    nprocs=n_workers,
+                    join=True,
+                )
+                result = queue.get()
+                print_result(result)
+                results.append(result)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "reducer_benchmark.json"), "w") as fp:
+        json.dump(results, fp, indent=1)
+
+
+def available_reducers():
+    names = [
+        name
+        for name, spec in gradient_reducers.REDUCERS.items()
+        if all(getattr(spec, capability) for capability in config["reducer_capabilities"])
+    ]
+    if not hasattr(gradient_reducers, "bit2byte"):
+        names = [name for name in names if name not in BIT2BYTE_REDUCERS]
+    if powersgd is not None and "supports_async" not in config["reducer_capabilities"]:
+        names += POWERSGD_AGGREGATORS
+    return names
+
+
+def benchmark_worker(rank, n_workers, store_port, model_name, reducer_name, config, queue):
+    timeout = datetime.timedelta(seconds=120)
+    dist.init_process_group(
+        backend=config["distributed_backend"],
+        store=dist.TCPStore("127.0.0.1", store_port, is_master=False, timeout=timeout),
+        timeout=timeout,
+        world_size=n_workers,
+        rank=rank,
+    )
+    device = torch.device(config["device"])
+    torch.manual_seed(config["seed"] + rank)
+    generator = torch.Generator(device=device).manual_seed(config["seed"] + rank)
+
+    shapes = [param.shape for param in build_model(model_name, config).parameters()]
+    params = [torch.zeros(shape, device=device) for shape in shapes]
+    timer = Timer(verbosity_level=2, log_fn=lambda *args, **kwargs: None, skip_first=False)
+
+    is_powersgd = reducer_name in POWERSGD_AGGREGATORS
+    if is_powersgd:
+        aggregator = build_powersgd_aggregator(reducer_name, params, config)
+        use_memory = True
+    else:
+        aggregator = gradient_reducers.build_reducer(reducer_name, config, device, timer)
+        use_memory = gradient_reducers.REDUCERS[reducer_name].supports_error_feedback
+
+    memories = [torch.zeros_like(param) for param in params]
+    send_buffers = [torch.zeros_like(param) for param in params]
+    outputs = [torch.zeros_like(param) for param in params]
+
+    bytes_communicated = 0
+    relative_errors = []
+    memory_before = reset_peak_memory(device)
+    for repetition in range(config["warmup_repetitions"] + config["repetitions"]):
+        if repetition == config["warmup_repetitions"]:
+            timer.reset()
+            bytes_communicated = 0
+            relative_errors = []
+
+        for send_bfr, memory in zip(send_buffers, memories):
+            send_bfr.normal_(generator=generator)
+            if use_memory:
+                send_bfr.add_(memory)
+        exact = exact_average(send_buffers)
+
+        dist.barrier()
+        if is_powersgd:
+            # The powersgd package keeps its error feedback in the tensors it aggregates
+            aggregator.communication.reset()
+            with timer("batch.reduce"):
+                outputs = aggregator.aggregate(send_buffers)
+            bytes_communicated += aggregator.communication.total_bytes
+            memories, send_buffers = send_buffers, memories
+        else:
+            with timer("batch.reduce"):
+                bits = aggregator.reduce(send_buffers, outputs, memories)
+            bytes_communicated += bits // 8
+
+        relative_errors.append(relative_error(outputs, exact))
+
+    peak_memory = max_memory(device) - memory_before
+
+    if rank == 0:
+        queue.put(
+            {
+                "reducer": reducer_name,
+                "model": model_name,
+                "n_workers": n_workers,
+                "n_params": sum(param.nelement() for param in params),
+                "phases": {
+                    label: timer.totals[label] / timer.call_counts[label]
+                    for label in sorted(timer.totals)
+                    if timer.call_counts[label] > 0
+                },
+                "bytes_per_step": bytes_communicated / config["repetitions"],
+                "peak_memory": peak_memory,
+                "relative_error": sum(relative_errors) / len(relative_errors),
+            }
+        )
+
+    dist.destroy_process_group()
+
+
+def build_model(model_name, config):
+    if model_name == "LSTM":
+        from tasks.language_modeling.model import RNNModel
+
+        # Matches define_model() in tasks/language_modeling
+        return RNNModel(
+            rnn_type="LSTM",
+            ntoken=config["lstm_vocab_size"],
+            ninp=650,
+            nhid=650,
+            nlayers=3,
+            tie_weights=True,
+        )
+    else:
+        return getattr(cifar_architectures, model_name)()
+
+
+def build_powersgd_aggregator(reducer_name, params, config):
+    if reducer_name == "powersgd.AllReduce":
+        aggregator = powersgd.AllReduce()
+    elif reducer_name == "powersgd.PowerSGD":
+        aggregator = powersgd.PowerSGD(
+            params,
+            config=powersgd.Config(
+                rank=config["optimizer_reducer_rank"],
+                min_compression_rate=config["powersgd_min_compression_rate"],
+                num_iters_per_step=config["powersgd_num_iters_per_step"],
+                start_compressing_after_num_steps=0,
+            ),
+        )
+    else:
+        raise ValueError(f"Unknown aggregator {reducer_name}")
+    aggregator.communication = CommunicationLog()
+    return aggregator
+
+
+def exact_average(tensors):
+    flat = torch.cat([tensor.view(-1) for tensor in tensors])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    return flat
+
+
+def relative_error(outputs, exact):
+    approximation = torch.cat([out.view(-1) for out in outputs])
+    return (torch.norm(approximation - exact) / torch.norm(exact)).item()
+
+
+def reset_peak_memory(device):
+    """Measure the peak memory from now on, and return the memory in use now"""
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        return torch.cuda.memory_allocated(device)
+    # Sets the peak resident set size (VmHWM) back to the current one
+    with open("/proc/self/clear_refs", "w") as fp:
+        fp.write("5")
+    return proc_status_bytes("VmRSS")
+
+
+def max_memory(device):
+    """Peak memory in use since `reset_peak_memory`"""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    return proc_status_bytes("VmHWM")
+
+
+def proc_status_bytes(key):
+    with open("/proc/self/status") as fp:
+        for line in fp:
+            if line.startswith(key + ":"):
+                return int(line.split()[1]) * 1024  # reported in kilobytes
+    raise KeyError(key)
+
+
+def host_store():
+    """
+    A rendezvous store in this process, on a port that the OS picks when it is bound,
+    so there is no window in which another process can take the port.
+    """
+    return dist.TCPStore(
+        "127.0.0.1",
+        0,
+        is_master=True,
+        wait_for_workers=False,
+        timeout=datetime.timedelta(seconds=120),
+    )
+
+
+def print_result(result):
+    print(
+        "{reducer:32s} {model:16s} {n_workers:2d} workers | "
+        "{reduce:9.5f}s | {mb:9.3f} MB/step | peak {peak:8.1f} MB | rel. error {error:6.4f}".format(
+            reducer=result["reducer"],
+            model=result["model"],
+            n_workers=result["n_workers"],
+            reduce=result["phases"].get("batch.reduce", float("nan")),
+            mb=result["bytes_per_step"] / 1e6,
+            peak=result["peak_memory"] / 1e6,
+            error=result["relative_error"],
+        )
+    )
+    for label, duration in result["phases"].items():
+        if label != "batch.reduce":
+            print(f"    - {label:30s} {duration:9.5f}s")
+
+
+if __name__ == "__main__":
+    main()
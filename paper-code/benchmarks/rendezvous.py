@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+Measures how long workers take to form a process group with the launcher of testing.py.
+
+Starts `num_jobs` jobs of `n_workers` processes at the same time on this host. Every
+worker joins its job's process group, runs one barrier and reports how long that took
+since the launch. Jobs get separate stores on OS-assigned ports, so they do not collide.
+
+Run it from the paper-code directory:
+    python -m benchmarks.rendezvous
+"""
+
+import statistics
+import time
+
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from testing import init_process_group, launch
+
+config = dict(
+    distributed_backend="gloo",
+    distributed_host="127.0.0.1",
+    n_workers=4,
+    num_jobs=[1, 4, 16],
+)
+
+
+def main():
+    queue = mp.get_context("fork").SimpleQueue()
+    for num_jobs in config["num_jobs"]:
+        start = time.perf_counter()
+        jobs = [
+            launch(rendezvous, config["n_workers"], config, args=(queue,))
+            for _ in range(num_jobs)
+        ]
+        for context, store in jobs:
+            while not context.join():
+                pass
+        wall_time = time.perf_counter() - start
+
+        rendezvous_times = []
+        since_launch = []
+        for _ in range(num_jobs * config["n_workers"]):
+            rendezvous_time, time_since_launch = queue.get()
+            rendezvous_times.append(rendezvous_time)
+            since_launch.append(time_since_launch)
+        print(
+            f"{num_jobs:3d} jobs | "
+            f"rendezvous median {1e3 * statistics.median(rendezvous_times):7.1f} ms, "
+            f"max {1e3 * max(rendezvous_times):7.1f} ms | "
+            f"launch to barrier max {1e3 * max(since_launch):7.1f} ms | "
+            f"total {wall_time:.2f} s"
+        )
+
+
+def rendezvous(rank, world_size, config, store_port, launch_time, queue):
+    start = time.perf_counter()
+    init_process_group(rank, world_size, config, store_port)
+    dist.barrier()
+    queue.put((time.perf_counter() - start, time.time() - launch_time))
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    main()
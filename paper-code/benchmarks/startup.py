@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+Measures the time from process start to the first training batch, per stage.
+
+Every repetition runs in a fresh interpreter, so imports are not cached. The
+child process times the imports, the process group, the task, the reducer and
+one training step, and the parent reports the median of each stage. The total
+includes the interpreter start-up, as seen from the parent.
+
+Run it from the paper-code directory:
+    python -m benchmarks.startup
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+config = dict(
+    distributed_backend="gloo",
+    device="cpu",
+    task="Cifar",
+    task_architecture="ResNet18",
+    optimizer_batch_size=128,
+    optimizer_reducer="RankKReducer",
+    optimizer_reducer_rank=2,
+    optimizer_reducer_reuse_query=True,
+    optimizer_reducer_n_power_iterations=0,
+    seed=42,
+    num_repetitions=5,
+)
+
+
+def main():
+    stages = {}
+    totals = []
+    for _ in range(config["num_repetitions"]):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.startup", "--child"],
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        totals.append(time.perf_counter() - start)
+        for stage, duration in json.loads(output.decode().splitlines()[-1]).items():
+            stages.setdefault(stage, []).append(duration)
+
+    for stage, durations in stages.items():
+        print(f"{stage:20s} | {statistics.median(durations):7.3f} s")
+    print(f"{'total':20s} | {statistics.median(totals):7.3f} s")
+
+
+def child():
+    durations = {}
+    start = time.perf_counter()
+
+    def stage(name):
+        nonlocal start
+        now = time.perf_counter()
+        durations[name] = now - start
+        start = now
+
+    import torch
+
+    stage("import torch")
+
+    import torch.distributed as dist
+
+    import gradient_reducers
+    import tasks
+    from benchmarks.reducers import host_store
+    from timer import Timer
+
+    stage("import modules")
+
+    dist.init_process_group(
+        backend=config["distributed_backend"],
+        store=host_store(),
+        world_size=1,
+        rank=0,
+    )
+    stage("process group")
+
+    device = torch.device(config["device"])
+    timer = Timer(verbosity_level=1, log_fn=lambda *args, **kwargs: None)
+    task = tasks.build(task_name=config["task"], timer=timer, **{**config, "device": device})
+    stage("task")
+
+    reducer = gradient_reducers.build_reducer(config["optimizer_reducer"], config, device, timer)
+    memories = [torch.zeros_like(param) for param in task.state]
+    send_buffers = [torch.zeros_like(param) for param in task.state]
+    stage("reducer")
+
+    batch = next(iter(task.train_iterator(config["optimizer_batch_size"])))
+    stage("first batch load")
+
+    _, grads, _ = task.batch_loss_and_gradient(batch)
+    for grad, memory, send_bfr in zip(grads, memories, send_buffers):
+        send_bfr.data[:] = grad + memory
+    reducer.reduce(send_buffers, grads, memories)
+    stage("first step")
+
+    dist.destroy_process_group()
+    print(json.dumps(durations))
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        child()
+    else:
+        main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+"""
+Measures the overhead of one timed region in the different modes of Timer.
+
+Times `num_regions` empty regions per mode and reports the time per region,
+minus the time of an empty loop. The training loop has ~20 regions per batch
+at verbosity 2.
+
+Run it from the paper-code directory:
+    python -m benchmarks.timer_overhead
+"""
+
+import time
+
+from timer import Timer
+
+config = dict(
+    num_regions=200_000,
+    num_labels=20,
+    buffer_size=65_536,
+)
+
+MODES = {
+    "skipped (verbosity too high)": dict(verbosity_level=0),
+    "default": dict(),
+    "no cuda sync": dict(cuda_sync=False),
+    "ring buffer, no cuda sync": dict(cuda_sync=False, buffer_size=config["buffer_size"]),
+}
+
+
+def main():
+    labels = [f"batch.region{i}" for i in range(config["num_labels"])]
+    baseline = time_regions(None, labels)
+
+    for mode, kwargs in MODES.items():
+        timer = Timer(log_fn=lambda *args, **kwargs: None, **kwargs)
+        duration = time_regions(timer, labels)
+        timer.close()
+        overhead = (duration - baseline) / config["num_regions"]
+        print(f"{mode:30s} | {overhead * 1e9:8.1f} ns/region")
+
+
+def time_regions(timer, labels):
+    num_labels = len(labels)
+    start = time.perf_counter()
+    for i in range(config["num_regions"]):
+        label = labels[i % num_labels]
+        if timer is not None:
+            with timer(label, verbosity=1):
+                pass
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""
+Checkpoints that are written in the background, split over the workers.
+
+A checkpoint is a directory with one file per worker and a metadata file:
+-   `shard.rank{r:03d}.ckpt` holds this worker's part of the state that is the same on all workers
+    (model, momenta), and all of the state that is local to the worker (error feedback memory).
+-   `metadata.ckpt` is written by rank 0 and holds the epoch, test statistics, and which shard
+    holds which shared tensor.
+Every file is written to a temporary name and renamed when it is complete, so a crash during
+writing never leaves a partial file behind. A checkpoint is only complete if all files exist
+and belong to the same save.
+
+The files are not pickles. They start with a JSON index of the saved structure, followed by the
+raw bytes of every tensor and numpy array, each aligned to `ALIGNMENT` bytes. Loading maps the
+file into memory and creates tensors that alias it, so nothing is copied, and only the parts of
+the file that are used are read from disk.
+"""
+
+import json
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+import numpy as np
+import torch
+
+METADATA_FILE = "metadata.ckpt"
+MAGIC = b"PSGDCKPT"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_HEADER_START = len(MAGIC) + 8  # the magic number and the index length
+
+
+def shard_file(rank):
+    return "shard.rank{:03d}.ckpt".format(rank)
+
+
+class AsyncCheckpointer:
+    """
+    Saves checkpoints from a background thread.
+
+    `save` copies the state into CPU staging buffers, which are reused between saves,
+    and returns before anything is written. Only one checkpoint is written at a time:
+    a new save first waits for the previous write to finish.
+    """
+
+    def __init__(self, rank, n_workers, timer=None):
+        self.rank = rank
+        self.n_workers = n_workers
+        self._timer = timer
+        self._staging = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        self._save_counter = 0
+        # Tells shards of this run apart from leftovers of an earlier run in the same directory
+        self._run_id = _shared_run_id()
+
+    def save(self, directory, shared_state, worker_state, metadata=None):
+        """
+        `shared_state` and `worker_state` map names to tensors, or to lists and dicts of them.
+        `shared_state` must be identical on all workers, it is divided between them.
+        `metadata` is only saved by rank 0.
+        """
+        self.wait()
+        self._save_counter += 1
+        save_id = (self._run_id, self._save_counter)
+
+        owners = assign_shards(shared_state, self.n_workers)
+        shard = {
+            "save_id": save_id,
+            "shared": {
+                name: self._snapshot(("shared", name), value)
+                for name, value in shared_state.items()
+                if owners[name] == self.rank
+            },
+            "worker": {
+                name: self._snapshot(("worker", name), value)
+                for name, value in worker_state.items()
+            },
+        }
+        if self.rank == 0:
+            metadata = {
+                "save_id": save_id,
+                "n_workers": self.n_workers,
+                "owners": owners,
+                "metadata": _to_cpu(metadata),
+            }
+
+        self._pending = self._executor.submit(self._write, directory, shard, metadata)
+
+    def wait(self):
+        """Block until the last checkpoint is on disk, and raise if writing it failed"""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def _write(self, directory, shard, metadata):
+        if self._timer is not None:
+            with self._timer("checkpointing.write"):
+                self._write_files(directory, shard, metadata)
+        else:
+            self._write_files(directory, shard, metadata)
+
+    def _write_files(self, directory, shard, metadata):
+        os.makedirs(directory, exist_ok=True)
+        write_tree(shard, os.path.join(directory, shard_file(self.rank)))
+        if self.rank == 0:
+            write_tree(metadata, os.path.join(directory, METADATA_FILE))
+
+    def _snapshot(self, key, value):
+        if isinstance(value, dict):
+            return {name: self._snapshot(key + (name,), entry) for name, entry in value.items()}
+        elif isinstance(value, (list, tuple)):
+            return type(value)(self._snapshot(key + (i,), entry) for i, entry in enumerate(value))
+        elif not isinstance(value, torch.Tensor):
+            return deepcopy(value)  # like random number generator states
+
+        buffer = self._staging.get(key)
+        if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+            buffer = torch.empty(value.shape, dtype=value.dtype, pin_memory=value.is_cuda)
+            self._staging[key] = buffer
+        buffer.copy_(value.detach(), non_blocking=True)
+        if value.is_cuda:
+            torch.cuda.current_stream(value.device).synchronize()
+        return buffer
+
+
+def assign_shards(shared_state, n_workers):
+    """
+    Map every name in `shared_state` to the rank that saves it, balancing the number of bytes.
+    The result only depends on the names and sizes, so it is the same on all workers.
+    """
+    sizes = {name: _num_bytes(value) for name, value in shared_state.items()}
+    loads = [0] * n_workers
+    owners = {}
+    for name in sorted(sizes, key=lambda name: (-sizes[name], name)):
+        rank = loads.index(min(loads))
+        owners[name] = rank
+        loads[rank] += sizes[name]
+    return owners
+
+
+def load_checkpoint(directory, rank, map_location="cpu", select=None):
+    """
+    Returns (metadata, shared_state, worker_state) for worker `rank`.
+    With `select`, only the entries of shared_state and worker_state whose name passes
+    `select(name)` are loaded, and shards without such entries are not opened.
+    On the CPU, tensors alias the memory-mapped files, and are only read when they are used.
+    Raises a RuntimeError if the checkpoint is incomplete.
+    """
+    metadata_path = os.path.join(directory, METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        raise RuntimeError(f"Incomplete checkpoint {directory}: missing {METADATA_FILE}")
+    index = read_tree(metadata_path, map_location)
+
+    def selected(names):
+        return [name for name in names if select is None or select(name)]
+
+    shared_state = {}
+    worker_state = {}
+    for shard_rank in range(index["n_workers"]):
+        owned = [name for name, owner in index["owners"].items() if owner == shard_rank]
+        if shard_rank != rank and not selected(owned):
+            continue
+        path = os.path.join(directory, shard_file(shard_rank))
+        if not os.path.exists(path):
+            raise RuntimeError(f"Incomplete checkpoint {directory}: missing {path}")
+        shard = read_tree(path, map_location)
+        if shard["save_id"] != index["save_id"]:
+            raise RuntimeError(f"Incomplete checkpoint {directory}: {path} is from another save")
+        for name in selected(shard["shared"]):
+            shared_state[name] = shard["shared"][name]
+        if shard_rank == rank:
+            for name in selected(shard["worker"]):
+                worker_state[name] = shard["worker"][name]
+
+    return index["metadata"], shared_state, worker_state
+
+
+def load_model_state(directory, rank=0, map_location="cpu"):
+    """
+    Only the model's state_dict (with worker `rank`'s buffers), for example for `task.test`.
+    Reads none of the momenta, error feedback or other training state.
+    """
+    _, shared_state, worker_state = load_checkpoint(
+        directory,
+        rank,
+        map_location,
+        select=lambda name: name.startswith("model.") or name == "model_buffers",
+    )
+    state_dict = dict(worker_state["model_buffers"])
+    for name, value in shared_state.items():
+        state_dict[name[len("model.") :]] = value
+    return state_dict
+
+
+def write_tree(tree, path):
+    """
+    Write `tree`, made of dicts with string keys, lists and tuples of tensors, numpy arrays
+    and JSON values, to a new file at `path`, atomically.
+    """
+    arrays = []
+    size = 0
+
+    def array_node(kind, dtype, shape, data):
+        nonlocal size
+        offset = _align(size)
+        arrays.append((offset, data))
+        size = offset + data.nbytes
+        return {kind: {"dtype": dtype, "shape": list(shape), "offset": offset}}
+
+    def encode(obj):
+        if isinstance(obj, torch.Tensor):
+            data = obj.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+            return array_node("tensor", str(obj.dtype)[len("torch.") :], obj.shape, data)
+        elif isinstance(obj, np.ndarray):
+            data = np.ascontiguousarray(obj).reshape(-1).view(np.uint8)
+            return array_node("ndarray", obj.dtype.str, obj.shape, data)
+        elif isinstance(obj, dict):
+            return {"dict": {key: encode(value) for key, value in obj.items()}}
+        elif isinstance(obj, (list, tuple)):
+            return {type(obj).__name__: [encode(value) for value in obj]}
+        elif isinstance(obj, np.generic):
+            return {"value": obj.item()}
+        else:
+            return {"value": obj}
+
+    index = json.dumps({"version": FORMAT_VERSION, "tree": encode(tree)}).encode()
+    data_start = _align(_HEADER_START + len(index))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack("<Q", len(index)))
+        fp.write(index)
+        position = _HEADER_START + len(index)
+        for offset, data in arrays:
+            fp.write(bytes(data_start + offset - position))  # padding
+            fp.write(data.data)
+            position = data_start + offset + data.nbytes
+    os.replace(tmp_path, path)
+
+
+def read_tree(path, map_location="cpu"):
+    """Read a file from `write_tree`, with tensors and arrays that alias the mapped file"""
+    with open(path, "rb") as fp:
+        # Copy-on-write: the tensors can be modified without changing the file
+        buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+    if buffer[: len(MAGIC)] != MAGIC:
+        raise RuntimeError(f"{path} is not a checkpoint file")
+    (index_length,) = struct.unpack("<Q", buffer[len(MAGIC) : _HEADER_START])
+    index = json.loads(buffer[_HEADER_START : _HEADER_START + index_length].decode())
+    if index["version"] != FORMAT_VERSION:
+        raise RuntimeError(f"{path} has unsupported format version {index['version']}")
+    data_start = _align(_HEADER_START + index_length)
+
+    def decode(node):
+        ((kind, content),) = node.items()
+        if kind == "tensor":
+            dtype = getattr(torch, content["dtype"])
+            numel = int(np.prod(content["shape"]))
+            if numel == 0:
+                return torch.empty(content["shape"], dtype=dtype, device=map_location)
+            tensor = torch.frombuffer(
+                buffer, dtype=dtype, count=numel, offset=data_start + content["offset"]
+            ).view(content["shape"])
+            return tensor.to(map_location)
+        elif kind == "ndarray":
+            dtype = np.dtype(content["dtype"])
+            numel = int(np.prod(content["shape"]))
+            if numel == 0:
+                return np.empty(content["shape"], dtype=dtype)
+            array = np.frombuffer(
+                buffer, dtype=dtype, count=numel, offset=data_start + content["offset"]
+            )
+            return array.reshape(content["shape"])
+        elif kind == "dict":
+            return {key: decode(value) for key, value in content.items()}
+        elif kind == "list":
+            return [decode(value) for value in content]
+        elif kind == "tuple":
+            return tuple(decode(value) for value in content)
+        else:
+            return content
+
+    return decode(index["tree"])
+
+
+def save_training_state(
+    checkpointer,
+    directory,
+    task,
+    reducer,
+    momenta,
+    memories,
+    memory_buffer,
+    runavg_model,
+    momenta_are_shared,
+    metadata,
+):
+    """
+    Start saving everything needed to continue training exactly where it is.
+    The parameters (and momenta, if they follow the averaged gradients) are the same on all
+    workers. Model buffers like BatchNorm statistics, the error feedback memory, the reducer's
+    state and the random number generators are local to each worker.
+    """
+    parameter_names = set(task.parameter_names)
+    shared_state = {}
+    worker_state = {"model_buffers": {}}
+    for name, value in task.state_dict().items():
+        if name in parameter_names:
+            shared_state["model." + name] = value
+        else:
+            worker_state["model_buffers"][name] = value
+
+    momentum_state = shared_state if momenta_are_shared else worker_state
+    for name, momentum in zip(task.parameter_names, momenta):
+        momentum_state["momentum." + name] = momentum
+
+    # With a low-precision memory, `memories` only hold a copy during the step
+    if memory_buffer is not None:
+        worker_state["memory_buffer"] = memory_buffer.state_dict()
+    elif memories is not None:
+        worker_state["memories"] = memories
+    worker_state["reducer"] = reducer.state_dict()
+    worker_state["runavg_model"] = runavg_model.state_dict()
+    worker_state["task"] = task.train_state_dict()
+    worker_state["rng"] = get_rng_states()
+
+    checkpointer.save(directory, shared_state, worker_state, metadata)
+
+
+def load_training_state(
+    directory, rank, task, reducer, momenta, memories, memory_buffer, runavg_model
+):
+    """Restore the state saved by `save_training_state` in place, and return its metadata"""
+    device = task.state[0].device
+    metadata, shared_state, worker_state = load_checkpoint(directory, rank, map_location=device)
+    state = {**shared_state, **worker_state}
+
+    model_state = dict(worker_state["model_buffers"])
+    for name in task.parameter_names:
+        model_state[name] = state["model." + name]
+    task.load_state_dict(model_state)
+
+    for name, momentum in zip(task.parameter_names, momenta):
+        momentum.data = state["momentum." + name].clone()
+    if memory_buffer is not None:
+        memory_buffer.load_state_dict(worker_state["memory_buffer"])
+    elif memories is not None:
+        for memory, value in zip(memories, worker_state["memories"]):
+            memory.copy_(value)
+    reducer.load_state_dict(worker_state["reducer"])
+    runavg_model.load_state_dict(worker_state["runavg_model"])
+    task.load_train_state_dict(worker_state["task"])
+    set_rng_states(worker_state["rng"])
+
+    return metadata
+
+
+def get_rng_states():
+    states = {"torch": torch.get_rng_state(), "numpy": np.random.get_state()}
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    torch.set_rng_state(states["torch"].cpu())
+    np.random.set_state(states["numpy"])
+    if "cuda" in states:
+        torch.cuda.set_rng_state_all([state.cpu() for state in states["cuda"]])
+
+
+def _shared_run_id():
+    run_id = [os.urandom(8).hex()]
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        torch.distributed.broadcast_object_list(run_id, src=0)
+    return run_id[0]
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu().clone()
+    elif isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    else:
+        return obj
+
+
+def _num_bytes(value):
+    if isinstance(value, dict):
+        return sum(_num_bytes(entry) for entry in value.values())
+    elif isinstance(value, (list, tuple)):
+        return sum(_num_bytes(entry) for entry in value)
+    elif isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    return 0
@@ -2,7 +2,7 @@ import datetime
 import os
 import time
 from contextlib import contextmanager
-from typing import List
+from typing import Dict, List, NamedTuple
 
 import numpy as np
 import torch
@@ -12,14 +12,20 @@ try:
 except ImportError:
     pass
 
+try:
+    # Communication is only counted with the powersgd package of this repository installed
+    from powersgd import communication
+    from powersgd.communication import CommunicationLog
+except ImportError:
+    communication = None
+    CommunicationLog = None
+
 
 class Reducer:
     def __init__(self, random_seed, device, timer):
         self.rng = np.random.RandomState(random_seed)
-        M = 1024 * 1024
-        self.precalc_numbers = (
-            torch.from_numpy(self.rng.randn(128 * M)).to(device).type(torch.float32)
-        )
+        self._random_seed = random_seed
+        self._precalc_numbers = None
         if torch.distributed.is_available():
             self.n_workers = torch.distributed.get_world_size()
             self.rank = torch.distributed.get_rank()
@@ -28,12 +34,96 @@ class Reducer:
             self.rank = 0
         self.device = device
         self.timer = timer
+        if CommunicationLog is not None:
+            self.communication = CommunicationLog(cuda_sync=timer.cuda_sync)
+        else:
+            self.communication = None
+
+    @property
+    def precalc_numbers(self):
+        """
+        A table of 128M normal random numbers (512 MB), created on first use.
+        It has its own random state so that creating it does not change `self.rng`.
+        """
+        if self._precalc_numbers is None:
+            M = 1024 * 1024
+            rng = np.random.RandomState(self._random_seed)
+            self._precalc_numbers = (
+                torch.from_numpy(rng.randn(128 * M)).to(self.device).type(torch.float32)
+            )
+        return self._precalc_numbers
+
+    def state_dict(self):
+        """State that carries over between steps, for checkpoints"""
+        return {"rng": self.rng.get_state()}
+
+    def load_state_dict(self, state):
+        self.rng.set_state(state["rng"])
 
     def reduce(self, grad_in, grad_out, memory_out):
-        """Return communicated bits"""
+        """
+        Return communicated bits.
+        `memory_out` may be the same list of tensors as `grad_in` (see `optimizer_memory_in_place`),
+        so a reducer must be done reading a gradient before it writes the corresponding memory.
+        """
         raise NotImplementedError()
 
 
+class ReducerSpec(NamedTuple):
+    """Registry entry describing how to construct a reducer from the training config"""
+
+    cls: type
+    config_schema: Dict[str, str]  # constructor argument -> config key
+    supports_error_feedback: bool  # leaves a meaningful residual in `memory_out`
+    supports_async: bool  # overlaps some of its communication with computation
+    all_reduce_compatible: bool  # communicates with all_reduce instead of all_gather
+
+
+REDUCERS: Dict[str, ReducerSpec] = {}
+
+
+def register_reducer(
+    config_schema=None,
+    supports_error_feedback=True,
+    supports_async=False,
+    all_reduce_compatible=False,
+):
+    """
+    Class decorator that makes a Reducer available to `build_reducer` under its class name.
+    `config_schema` maps constructor arguments to the config keys they are read from.
+    """
+
+    def decorator(cls):
+        REDUCERS[cls.__name__] = ReducerSpec(
+            cls=cls,
+            config_schema=dict(config_schema or {}),
+            supports_error_feedback=supports_error_feedback,
+            supports_async=supports_async,
+            all_reduce_compatible=all_reduce_compatible,
+        )
+        return cls
+
+    return decorator
+
+
+def build_reducer(name, config, device, timer):
+    """
+    Construct a new instance of the reducer registered as `name` with arguments taken
+    from `config`. Config keys that are missing fall back to the constructor's defaults.
+    """
+    if name not in REDUCERS:
+        raise ValueError(f"Unknown reducer {name}")
+    spec = REDUCERS[name]
+
+    kwargs = {
+        argument: config[key]
+        for argument, key in spec.config_schema.items()
+        if key in config and config[key] is not None
+    }
+    return spec.cls(random_seed=config["seed"], device=device, timer=timer, **kwargs)
+
+
+@register_reducer(supports_async=True)
 class SignAndNormReducer(Reducer):
     """
     Optimizations:
@@ -66,8 +156,8 @@ class SignAndNormReducer(Reducer):
             if self.n_workers > 1:
                 bits = [torch.empty_like(my_bits) for i in range(self.n_workers)]
                 norms = [torch.empty_like(my_norms) for i in range(self.n_workers)]
-                h1 = all_gather(bits, my_bits, async_op=True)
-                h2 = all_gather(norms, my_norms, async_op=True)
+                h1 = all_gather(bits, my_bits, self.communication, "reduce.gather", async_op=True)
+                h2 = all_gather(norms, my_norms, self.communication, "reduce.gather", async_op=True)
                 h1.wait()
                 h2.wait()
             else:
@@ -105,6 +195,7 @@ class SignAndNormReducer(Reducer):
         return bits_communicated
 
 
+@register_reducer()
 class SignReducer(Reducer):
     """
     Optimizations:
@@ -130,7 +221,7 @@ class SignReducer(Reducer):
         with self.timer("reduce.gather", verbosity=2):
             if self.n_workers > 1:
                 bits = [torch.empty_like(my_bits) for i in range(self.n_workers)]
-                h1 = all_gather(bits, my_bits)
+                h1 = all_gather(bits, my_bits, self.communication, "reduce.gather")
             else:
                 bits = [my_bits]
 
@@ -157,6 +248,7 @@ class SignReducer(Reducer):
         return bits_communicated
 
 
+@register_reducer(supports_error_feedback=False)
 class SignSGDwithMajorityVoteReducer(Reducer):
     def reduce(self, grad_in, grad_out, memory_out):
         """
@@ -177,7 +269,7 @@ class SignSGDwithMajorityVoteReducer(Reducer):
         with self.timer("reduce.gather", verbosity=2):
             if self.n_workers > 1:
                 bits = [torch.empty_like(my_bits) for i in range(self.n_workers)]
-                all_gather(bits, my_bits)
+                all_gather(bits, my_bits, self.communication, "reduce.gather")
             else:
                 bits = [my_bits]
 
@@ -206,6 +298,7 @@ class SignSGDwithMajorityVoteReducer(Reducer):
 
         return bits_communicated
 
+@register_reducer({"compression": "optimizer_reducer_compression"}, supports_async=True)
 class TopKReducer(Reducer):
     """
     Use same amount as rank-based
@@ -256,8 +349,16 @@ class TopKReducer(Reducer):
             if self.n_workers > 1:
                 worker_values = [torch.empty_like(flat_values) for i in range(self.n_workers)]
                 worker_positions = [torch.empty_like(flat_positions) for i in range(self.n_workers)]
-                h1 = all_gather(worker_values, flat_values, async_op=True)
-                h2 = all_gather(worker_positions, flat_positions, async_op=True)
+                h1 = all_gather(
+                    worker_values, flat_values, self.communication, "reduce.gather", async_op=True
+                )
+                h2 = all_gather(
+                    worker_positions,
+                    flat_positions,
+                    self.communication,
+                    "reduce.gather",
+                    async_op=True,
+                )
                 h1.wait()
                 h2.wait()
             else:
@@ -279,6 +380,7 @@ class TopKReducer(Reducer):
         return bits_communicated
 
 
+@register_reducer({"compression": "optimizer_reducer_compression"}, supports_async=True)
 class GlobalTopKReducer(Reducer):
     def __init__(self, random_seed, device, timer, compression=1 / 244):
         super().__init__(random_seed, device, timer)
@@ -327,8 +429,12 @@ class GlobalTopKReducer(Reducer):
             if self.n_workers > 1:
                 worker_values = [torch.empty_like(values) for i in range(self.n_workers)]
                 worker_positions = [torch.empty_like(positions) for i in range(self.n_workers)]
-                h1 = all_gather(worker_values, values, async_op=True)
-                h2 = all_gather(worker_positions, positions, async_op=True)
+                h1 = all_gather(
+                    worker_values, values, self.communication, "reduce.reduce", async_op=True
+                )
+                h2 = all_gather(
+                    worker_positions, positions, self.communication, "reduce.reduce", async_op=True
+                )
                 h1.wait()
                 h2.wait()
             else:
@@ -349,6 +455,9 @@ class GlobalTopKReducer(Reducer):
         return bits_communicated
 
 
+@register_reducer(
+    {"compression": "optimizer_reducer_compression"}, all_reduce_compatible=True
+)
 class UniformRandomSparseBlockReducer(Reducer):
     def __init__(self, random_seed, device, timer, compression=1 / 244):
         super().__init__(random_seed, device, timer)
@@ -382,19 +491,19 @@ class UniformRandomSparseBlockReducer(Reducer):
                 values_list.append(bfr)
 
         with self.timer("reduce.flatpack", verbosity=2):
-            flat_values = TensorBuffer(values_list)
+            flat_values = TensorBuffer(values_list, layers=range(len(grad_in)))
 
         with self.timer("reduce.memory", verbosity=2):
             for tensor, mem, start_idx, block_size in zip(grad_in, memory_out, start_idx_list, block_sizes):
                 end_idx = min(start_idx + block_size, tensor.nelement())
                 rest = block_size - (end_idx - start_idx)
-                mem.data = tensor.clone()
+                mem.data[:] = tensor
                 mem.view(-1)[start_idx:end_idx] = 0.0
                 if rest > 0:
                     mem.view(-1)[:rest] = 0.0
 
         with self.timer("reduce.reduce", verbosity=2):
-            flat_values.all_reduce()
+            flat_values.all_reduce(log=self.communication, phase="reduce.reduce")
             flat_values.buffer /= self.n_workers
             bits_communicated += flat_values.bits()
 
@@ -410,6 +519,9 @@ class UniformRandomSparseBlockReducer(Reducer):
         return bits_communicated
 
 
+@register_reducer(
+    {"compression": "optimizer_reducer_compression"}, all_reduce_compatible=True
+)
 class UniformRandomSparseReducer(Reducer):
     def __init__(self, random_seed, device, timer, compression=1 / 244):
         super().__init__(random_seed, device, timer)
@@ -436,7 +548,7 @@ class UniformRandomSparseReducer(Reducer):
                 values_list.append(values)
 
         with self.timer("reduce.flatpack", verbosity=2):
-            flat_values = TensorBuffer(values_list)
+            flat_values = TensorBuffer(values_list, layers=range(len(grad_in)))
 
         with self.timer("reduce.memory", verbosity=2):
             for tensor, mem, indices in zip(grad_in, memory_out, indices_list):
@@ -444,7 +556,7 @@ class UniformRandomSparseReducer(Reducer):
                 mem.view(-1)[indices] = 0.0
 
         with self.timer("reduce.reduce", verbosity=2):
-            flat_values.all_reduce()
+            flat_values.all_reduce(log=self.communication, phase="reduce.reduce")
             flat_values.buffer.data /= self.n_workers
             bits_communicated += flat_values.bits()
 
@@ -456,6 +568,7 @@ class UniformRandomSparseReducer(Reducer):
         return bits_communicated
 
 
+@register_reducer({"rank": "optimizer_reducer_rank"}, all_reduce_compatible=True)
 class RandomSparseBlockReducer(Reducer):
     def __init__(self, random_seed, device, timer, rank):
         super().__init__(random_seed, device, timer)
@@ -498,19 +611,19 @@ class RandomSparseBlockReducer(Reducer):
                 values_list.append(bfr)
 
         with self.timer("reduce.flatpack", verbosity=2):
-            flat_values = TensorBuffer(values_list)
+            flat_values = TensorBuffer(values_list, layers=range(len(grad_in)))
 
         with self.timer("reduce.memory", verbosity=2):
             for tensor, mem, start_idx, block_size in zip(grad_in, memory_out, start_idx_list, block_sizes):
                 end_idx = min(start_idx + block_size, tensor.nelement())
                 rest = block_size - (end_idx - start_idx)
-                mem.data = tensor.clone()
+                mem.data[:] = tensor
                 mem.view(-1)[start_idx:end_idx] = 0.0
                 if rest > 0:
                     mem.view(-1)[:rest] = 0.0
 
         with self.timer("reduce.reduce", verbosity=2):
-            flat_values.all_reduce()
+            flat_values.all_reduce(log=self.communication, phase="reduce.reduce")
             flat_values.buffer /= self.n_workers
             bits_communicated += flat_values.bits()
 
@@ -526,6 +639,7 @@ class RandomSparseBlockReducer(Reducer):
         return bits_communicated
 
 
+@register_reducer({"rank": "optimizer_reducer_rank"}, all_reduce_compatible=True)
 class RandomSparseReducer(Reducer):
     def __init__(self, random_seed, device, timer, rank):
         super().__init__(random_seed, device, timer)
@@ -561,7 +675,7 @@ class RandomSparseReducer(Reducer):
                 values_list.append(values)
 
         with self.timer("reduce.flatpack", verbosity=2):
-            flat_values = TensorBuffer(values_list)
+            flat_values = TensorBuffer(values_list, layers=range(len(grad_in)))
 
         with self.timer("reduce.memory", verbosity=2):
             for tensor, mem, indices in zip(grad_in, memory_out, indices_list):
@@ -569,7 +683,7 @@ class RandomSparseReducer(Reducer):
                 mem.view(-1)[indices] = 0.0
 
         with self.timer("reduce.reduce", verbosity=2):
-            flat_values.all_reduce()
+            flat_values.all_reduce(log=self.communication, phase="reduce.reduce")
             flat_values.buffer.data /= self.n_workers
             bits_communicated += flat_values.bits()
 
@@ -581,6 +695,7 @@ class RandomSparseReducer(Reducer):
         return bits_communicated
 
 
+@register_reducer({"rank": "optimizer_reducer_rank"}, supports_async=True)
 class SVDReducer(Reducer):
     def __init__(self, random_seed, device, timer, rank=1):
         super().__init__(random_seed, device, timer)
@@ -628,9 +743,9 @@ class SVDReducer(Reducer):
                 worker_u = [torch.empty_like(u) for i in range(self.n_workers)]
                 worker_v = [torch.empty_like(v) for i in range(self.n_workers)]
                 worker_s = [torch.empty_like(s) for i in range(self.n_workers)]
-                h1 = all_gather(worker_u, u, async_op=True)
-                h2 = all_gather(worker_v, v, async_op=True)
-                h3 = all_gather(worker_s, s, async_op=True)
+                h1 = all_gather(worker_u, u, self.communication, "reduce.gather", async_op=True)
+                h2 = all_gather(worker_v, v, self.communication, "reduce.gather", async_op=True)
+                h3 = all_gather(worker_s, s, self.communication, "reduce.gather", async_op=True)
                 h1.wait()
                 h2.wait()
                 h3.wait()
@@ -650,18 +765,31 @@ class SVDReducer(Reducer):
         return bits_communicated
 
     def _reduce_rank1(self, pairs):
-        with self.timer("reduce.rank1.zero_memory", verbosity=2):
-            for _, _, mem in pairs:
-                mem.zero_()
-
         list_in = [tensor for (tensor, _, _) in pairs]
         list_out = [out for (_, out, _) in pairs]
 
         with self.timer("reduce.rank1.reduce", verbosity=2):
-            return reduce_mean_list(self.device, list_in, list_out, self.timer)
+            bits_communicated = reduce_mean_list(
+                self.device, list_in, list_out, self.timer, self.communication
+            )
 
+        with self.timer("reduce.rank1.zero_memory", verbosity=2):
+            for _, _, mem in pairs:
+                mem.zero_()
+
+        return bits_communicated
 
 
+
+@register_reducer(
+    {
+        "n_power_iterations": "optimizer_reducer_n_power_iterations",
+        "reuse_query": "optimizer_reducer_reuse_query",
+        "rank": "optimizer_reducer_rank",
+    },
+    supports_async=True,
+    all_reduce_compatible=True,
+)
 class RankKReducer(Reducer):
     def __init__(self, random_seed, device, timer, n_power_iterations=0, reuse_query=False, rank=1):
         super().__init__(random_seed, device, timer)
@@ -671,6 +799,19 @@ class RankKReducer(Reducer):
         self.q_memory = None
         self.reuse_query = reuse_query
 
+    def state_dict(self):
+        state = super().state_dict()
+        state["p_memory"] = self.p_memory
+        state["q_memory"] = self.q_memory
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.p_memory, self.q_memory = (
+            None if state[key] is None else state[key].to(self.device, copy=True)
+            for key in ["p_memory", "q_memory"]
+        )
+
     def set_random(self, vector):
         torch.manual_seed(self.rng.randint(1_000_000_000))
         vector.data[:] = torch.randn(*vector.shape, device=self.device)
@@ -697,6 +838,8 @@ class RankKReducer(Reducer):
             for tensor, out, mem in zip(grad_in, grad_out, memory_out)
             if tensor.ndimension() > 1
         ]
+        rank1_layers = [i for i, tensor in enumerate(grad_in) if tensor.ndimension() <= 1]
+        high_rank_layers = [i for i, tensor in enumerate(grad_in) if tensor.ndimension() > 1]
 
         # We are building a rank-1 approximation of every tensor
         # that can be interpreted as a matrix. Let the approximation be
@@ -721,14 +864,18 @@ class RankKReducer(Reducer):
             # Find them again and make lists of pointers
             ps = []
             qs = []
+            p_layers = {}  # bytes per layer, to count communication
+            q_layers = {}
             p_idx = 0
             q_idx = 0
-            for tensor, _, _ in high_rank_tensors:
+            for layer, (tensor, _, _) in zip(high_rank_layers, high_rank_tensors):
                 matrix = tensor.view(tensor.shape[0], -1)
                 n, m = matrix.shape
                 rank = min(n, m, self.rank)
                 ps.append(self.p_memory[p_idx : p_idx + n * rank].view(n, rank))
                 qs.append(self.q_memory[q_idx : q_idx + m * rank].view(m, rank))
+                p_layers[layer] = n * rank * self.p_memory.element_size()
+                q_layers[layer] = m * rank * self.q_memory.element_size()
                 p_idx += n * rank
                 q_idx += m * rank
 
@@ -750,14 +897,18 @@ class RankKReducer(Reducer):
                 torch.matmul(matrix, q, out=p)
 
         with self.timer("reduce.p", verbosity=2):
-            all_reduce(self.p_memory)
+            all_reduce(self.p_memory, self.communication, "reduce.p", p_layers)
             bits_communicated += n_bits(self.p_memory)
 
         # Start communicating rank 1 tensors
         with self.timer("reduce.rank1.pack", verbosity=2):
-            rank1_tensor_list = TensorBuffer([tensor for (tensor, _, _) in rank1_tensors])
+            rank1_tensor_list = TensorBuffer(
+                [tensor for (tensor, _, _) in rank1_tensors], layers=rank1_layers
+            )
         with self.timer("reduce.rank1.all_reduce", verbosity=2):
-            rank1_handle = rank1_tensor_list.all_reduce(async_op=True)
+            rank1_handle = rank1_tensor_list.all_reduce(
+                async_op=True, log=self.communication, phase="reduce.rank1.all_reduce"
+            )
             bits_communicated += rank1_tensor_list.bits()
 
         with self.timer("reduce.normalize.p", verbosity=2):
@@ -770,7 +921,7 @@ class RankKReducer(Reducer):
                 torch.matmul(matrix.t(), p, out=q)
 
         with self.timer("reduce.q", verbosity=2):
-            all_reduce(self.q_memory)
+            all_reduce(self.q_memory, self.communication, "reduce.q", q_layers)
             bits_communicated += n_bits(self.q_memory)
             self.q_memory.data[:] /= self.n_workers
 
@@ -778,12 +929,14 @@ class RankKReducer(Reducer):
             for p, q, (tensor, out, mem) in zip(ps, qs, high_rank_tensors):
                 # Set the output gradient
                 torch.matmul(p, q.t(), out=out.data[:])
-                mem.data[:] = tensor - out
+                torch.sub(tensor, out, out=mem)
 
         with self.timer("reduce.rank1.unpack", verbosity=2):
             rank1_handle.wait()
             rank1_tensor_list.buffer /= self.n_workers
             rank1_tensor_list.unpack([out for (_, out, _) in rank1_tensors])
+            for _, _, mem in rank1_tensors:
+                mem.zero_()
 
         return bits_communicated
 
@@ -791,6 +944,9 @@ class RankKReducer(Reducer):
 
 
 
+@register_reducer(
+    {"rank": "optimizer_reducer_rank"}, supports_async=True, all_reduce_compatible=True
+)
 class HalfRankKReducer(Reducer):
     """
     This is an adapted version of RankKReducer that
@@ -804,6 +960,21 @@ class HalfRankKReducer(Reducer):
         self.q_memory = None
         self.next_operation = "p"  # or q, binary state
 
+    def state_dict(self):
+        state = super().state_dict()
+        state["p_memory"] = self.p_memory
+        state["q_memory"] = self.q_memory
+        state["next_operation"] = self.next_operation
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.p_memory, self.q_memory = (
+            None if state[key] is None else state[key].to(self.device, copy=True)
+            for key in ["p_memory", "q_memory"]
+        )
+        self.next_operation = state["next_operation"]
+
     def set_random(self, vector):
         torch.manual_seed(self.rng.randint(1_000_000_000))
         vector.data[:] = torch.randn(*vector.shape, device=self.device)
@@ -830,12 +1001,18 @@ class HalfRankKReducer(Reducer):
             for tensor, out, mem in zip(grad_in, grad_out, memory_out)
             if tensor.ndimension() > 1
         ]
+        rank1_layers = [i for i, tensor in enumerate(grad_in) if tensor.ndimension() <= 1]
+        high_rank_layers = [i for i, tensor in enumerate(grad_in) if tensor.ndimension() > 1]
 
         # Communicate rank 1 tensors
         with self.timer("reduce.rank1.pack", verbosity=2):
-            rank1_tensor_list = TensorBuffer([tensor for (tensor, _, _) in rank1_tensors])
+            rank1_tensor_list = TensorBuffer(
+                [tensor for (tensor, _, _) in rank1_tensors], layers=rank1_layers
+            )
         with self.timer("reduce.rank1.all_reduce", verbosity=2):
-            rank1_handle = rank1_tensor_list.all_reduce(async_op=True)
+            rank1_handle = rank1_tensor_list.all_reduce(
+                async_op=True, log=self.communication, phase="reduce.rank1.all_reduce"
+            )
             bits_communicated += rank1_tensor_list.bits()
 
         # We are building a rank-1 approximation of every tensor
@@ -861,14 +1038,18 @@ class HalfRankKReducer(Reducer):
         with self.timer("reduce.build_index", verbosity=2):
             ps = []
             qs = []
+            p_layers = {}  # bytes per layer, to count communication
+            q_layers = {}
             p_idx = 0
             q_idx = 0
-            for tensor, _, _ in high_rank_tensors:
+            for layer, (tensor, _, _) in zip(high_rank_layers, high_rank_tensors):
                 matrix = tensor.view(tensor.shape[0], -1)
                 n, m = matrix.shape
                 rank = min(n, m, self.rank)
                 ps.append(self.p_memory[p_idx : p_idx + n * rank].view(n, rank))
                 qs.append(self.q_memory[q_idx : q_idx + m * rank].view(m, rank))
+                p_layers[layer] = n * rank * self.p_memory.element_size()
+                q_layers[layer] = m * rank * self.q_memory.element_size()
                 p_idx += n * rank
                 q_idx += m * rank
 
@@ -890,12 +1071,10 @@ class HalfRankKReducer(Reducer):
                 for p, q, (tensor, _, mem) in zip(ps, qs, high_rank_tensors):
                     matrix = tensor.view(tensor.shape[0], -1)
                     # Keep what we couldn't send in memory
-                    mem.data[:] = (matrix - torch.einsum("nr, mr -> nm", (p, q))).view(
-                        *tensor.shape
-                    )
+                    torch.addmm(matrix, p, q.t(), alpha=-1, out=mem.view(*matrix.shape))
 
             with self.timer("reduce.p", verbosity=2):
-                all_reduce(self.p_memory)
+                all_reduce(self.p_memory, self.communication, "reduce.p", p_layers)
                 bits_communicated += n_bits(self.p_memory)
                 self.p_memory.data[:] /= self.n_workers
 
@@ -914,12 +1093,10 @@ class HalfRankKReducer(Reducer):
                 for p, q, (tensor, _, mem) in zip(ps, qs, high_rank_tensors):
                     matrix = tensor.view(tensor.shape[0], -1)
                     # Keep what we couldn't send in memory
-                    mem.data[:] = (matrix - torch.einsum("nr, mr -> nm", (p, q))).view(
-                        *tensor.shape
-                    )
+                    torch.addmm(matrix, p, q.t(), alpha=-1, out=mem.view(*matrix.shape))
 
             with self.timer("reduce.q", verbosity=2):
-                all_reduce(self.q_memory)
+                all_reduce(self.q_memory, self.communication, "reduce.q", q_layers)
                 bits_communicated += n_bits(self.q_memory)
                 self.q_memory.data[:] /= self.n_workers
 
@@ -932,6 +1109,8 @@ class HalfRankKReducer(Reducer):
             rank1_handle.wait()
             rank1_tensor_list.buffer /= self.n_workers
             rank1_tensor_list.unpack([out for (_, out, _) in rank1_tensors])
+            for _, _, mem in rank1_tensors:
+                mem.zero_()
 
         return bits_communicated
 
@@ -956,6 +1135,7 @@ def orthogonalize(matrix, eps=torch.tensor(1e-8)):
             rest -= torch.sum(col * rest, dim=0) * col
 
 
+@register_reducer(all_reduce_compatible=True)
 class ExactReducer(Reducer):
     def reduce(self, grad_in, grad_out, memory_out):
         """
@@ -964,20 +1144,23 @@ class ExactReducer(Reducer):
         :param grad_out: dictionary
         :param memory_out: dictionary
         """
-        with self.timer("reduce.zero_mem", verbosity=2):
-            for mem in memory_out:
-                mem.zero_()
-
         with self.timer("reduce.build_lists", verbosity=2):
             list_in = grad_in
             list_out = grad_out
 
         with self.timer("reduce.reduce", verbosity=2):
-            bits_communicated = reduce_mean_list(self.device, list_in, list_out, self.timer)
+            bits_communicated = reduce_mean_list(
+                self.device, list_in, list_out, self.timer, self.communication
+            )
+
+        with self.timer("reduce.zero_mem", verbosity=2):
+            for mem in memory_out:
+                mem.zero_()
 
         return bits_communicated
 
 
+@register_reducer({"rank": "optimizer_reducer_rank"}, supports_error_feedback=False)
 class AtomoReducer(Reducer):
     def __init__(self, random_seed, device, timer, rank=1):
         super().__init__(random_seed, device, timer)
@@ -1062,10 +1245,11 @@ class AtomoReducer(Reducer):
                 ss.append(s)
 
         with self.timer("reduce.pack", verbosity=2):
-            bfr = TensorBuffer(us + ss + vs)
+            layers = range(len(grad_in))
+            bfr = TensorBuffer(us + ss + vs, layers=[*layers, *layers, *layers])
 
         with self.timer("reduce.allgather", verbosity=2):
-            all_workers_encoded = bfr.all_gather()
+            all_workers_encoded = bfr.all_gather(log=self.communication, phase="reduce.allgather")
             bits_communicated += bfr.bits()
 
         with self.timer("reduce.decode", verbosity=2):
@@ -1094,7 +1278,11 @@ class AtomoReducer(Reducer):
 
 
 def reduce_mean_list(
-    device: torch.device, list_in: List[torch.Tensor], list_out: List[torch.Tensor], timer
+    device: torch.device,
+    list_in: List[torch.Tensor],
+    list_out: List[torch.Tensor],
+    timer,
+    log=None,
 ):
     if torch.distributed.is_available():
         n_workers = torch.distributed.get_world_size()
@@ -1107,10 +1295,10 @@ def reduce_mean_list(
         return 0
 
     with timer("reduce.mean.pack"):
-        buffer = TensorBuffer(list_in)
+        buffer = TensorBuffer(list_in, layers=range(len(list_in)))
 
     with timer("reduce.mean.allreduce"):
-        buffer.all_reduce()
+        buffer.all_reduce(log=log, phase="reduce.mean.allreduce")
         buffer.buffer /= n_workers
         bits_communicated = buffer.bits()
 
@@ -1129,7 +1317,8 @@ class TensorBuffer():
     Packs multiple tensors into one flat buffer for efficient
     intra-worker communication.
     """
-    def __init__(self, tensors):
+    def __init__(self, tensors, layers=None):
+        """`layers` optionally names the tensors, to count communication per layer"""
         indices = [0]
         for tensor in tensors:
             new_end = indices[-1] + tensor.nelement()
@@ -1138,6 +1327,7 @@ class TensorBuffer():
         self._start_idx = indices[:-1]
         self._end_idx = indices[1:]
         self._tensors = tensors
+        self._layers = layers
 
         self.buffer = torch.cat([t.view(-1) for t in tensors]) # copies
     
@@ -1167,27 +1357,49 @@ class TensorBuffer():
     def bits(self):
         return 8 * self.nelement() * self.element_size()
 
-    def all_reduce(self, async_op=False):
-        return torch.distributed.all_reduce(self.buffer, async_op=async_op)
+    def layer_bytes(self):
+        """How many bytes of the buffer belong to each layer"""
+        if self._layers is None:
+            return None
+        layer_bytes = {}
+        for layer, tensor in zip(self._layers, self._tensors):
+            layer_bytes[layer] = layer_bytes.get(layer, 0) + tensor.nelement() * self.element_size()
+        return layer_bytes
+
+    def all_reduce(self, async_op=False, log=None, phase=""):
+        if log is None:
+            return torch.distributed.all_reduce(self.buffer, async_op=async_op)
+        return communication.all_reduce(
+            self.buffer, log, phase, self.layer_bytes(), async_op=async_op
+        )
     
-    def all_gather(self, async_op=False):
+    def all_gather(self, async_op=False, log=None, phase=""):
         n_workers = torch.distributed.get_world_size() if torch.distributed.is_available() else 1
         buffers = [torch.empty_like(self.buffer) for i in range(n_workers)]
-        handle = all_gather(buffers, self.buffer, async_op=async_op)
+        handle = all_gather(
+            buffers, self.buffer, log, phase, self.layer_bytes(), async_op=async_op
+        )
         if async_op:
             return buffers, handle
         else:
             return buffers
     
 
-def all_reduce(*args, **kwargs):
+def all_reduce(tensor, log=None, phase="", layers=None, async_op=False):
+    """All-reduce that is skipped on a single worker, and recorded in `log` if it is given"""
     if torch.distributed.is_available() and torch.distributed.get_world_size() > 1:
-        return torch.distributed.all_reduce(*args, **kwargs)
+        if log is None:
+            return torch.distributed.all_reduce(tensor, async_op=async_op)
+        return communication.all_reduce(tensor, log, phase, layers, async_op=async_op)
 
 
-def all_gather(out_list, in_tensor, **kwargs):
+def all_gather(out_list, in_tensor, log=None, phase="", layers=None, async_op=False):
     if torch.distributed.is_available() and torch.distributed.get_world_size() > 1:
-        return torch.distributed.all_gather(out_list, in_tensor, **kwargs)
+        if log is None:
+            return torch.distributed.all_gather(out_list, in_tensor, async_op=async_op)
+        return communication.all_gather(
+            out_list, in_tensor, log, phase, layers, async_op=async_op
+        )
     else:
         assert len(out_list) == 1
         out_list[0].data = in_tensor
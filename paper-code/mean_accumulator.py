@@ -7,49 +7,67 @@ class MeanAccumulator:
         self.average = None
         self.counter = 0
         self.update_weight = update_weight
+        self._is_float = False  # a float average that is temporarily a tensor, after reduce()
 
     def value(self):
         if isinstance(self.average, dict):
             return {k: v.value() for k, v in self.average.items()}
         elif isinstance(self.average, list):
             return [v.value() for v in self.average]
+        elif self._is_float:
+            return self.average.item()
         else:
             return self.average
 
     def reduce(self):
-        """Reduce over workers"""
+        """
+        Reduce over workers.
+        All values and counters are packed into one buffer for a single all-reduce.
+        Averages that were Python floats become 0-dim tensors until `value()` reads them,
+        so this does not wait for the result.
+        """
         if not torch.distributed.is_available() or torch.distributed.get_world_size() == 1:
             # Skip this if there is only one worker
             return
 
-        if isinstance(self.average, dict):
-            for key in sorted(self.average.keys()):
-                self.average[key].reduce()
-        elif isinstance(self.average, list):
-            for avg in self.average:
-                avg.reduce()
-        else:
-            device = "cuda" if torch.distributed.get_backend() == "nccl" else "cpu"
-            total_count = torch.tensor(self.counter, dtype=torch.float32, device=device)
-            handle_tc = torch.distributed.all_reduce(total_count, async_op=True)
-
-            # Average * count
-            if isinstance(self.average, torch.Tensor):
-                multiplied = self.average.clone()
-            else:
-                multiplied = torch.tensor(self.average, dtype=torch.float32, device=device)
-            multiplied.mul_(self.counter)
-            handle_mul = torch.distributed.all_reduce(multiplied, async_op=True)
-
-            handle_tc.wait()
-            handle_mul.wait()
+        leaves = self._leaves()
+        if len(leaves) == 0:
+            return
+        device = "cuda" if torch.distributed.get_backend() == "nccl" else "cpu"
 
-            self.counter = total_count.item()
+        # Average * count for every leaf, followed by the counts
+        weighted_sums = [
+            torch.as_tensor(leaf.average, dtype=torch.float32, device=device).reshape(-1)
+            * leaf.counter
+            for leaf in leaves
+        ]
+        counts = torch.tensor([float(leaf.counter) for leaf in leaves], device=device)
+        buffer = torch.cat(weighted_sums + [counts])
+        torch.distributed.all_reduce(buffer)
 
-            if isinstance(self.average, torch.Tensor):
-                self.average.data = multiplied / total_count
+        total_counts = buffer[-len(leaves) :]
+        offset = 0
+        for i, leaf in enumerate(leaves):
+            if isinstance(leaf.average, torch.Tensor):
+                shape = leaf.average.shape
             else:
-                self.average = (multiplied / total_count).item()
+                shape = torch.Size([])
+                leaf._is_float = True
+            numel = shape.numel()
+            leaf.average = buffer[offset : offset + numel].view(shape) / total_counts[i]
+            leaf.counter = total_counts[i]
+            offset += numel
+
+    def _leaves(self):
+        """All accumulators with a tensor or float value, in a fixed order"""
+        if isinstance(self.average, dict):
+            return [leaf for key in sorted(self.average) for leaf in self.average[key]._leaves()]
+        elif isinstance(self.average, list):
+            return [leaf for avg in self.average for leaf in avg._leaves()]
+        elif self.average is None:
+            return []
+        else:
+            return [self]
 
     def add(self, value, weight=1.0):
         """Add a value to the average"""
@@ -96,3 +114,171 @@ class MeanAccumulator:
     def reset(self):
         self.average = None
         self.counter = 0
+        self._is_float = False
+
+
+class ModelAverage:
+    """
+    Running average of a model's state_dict, in one preallocated float32 buffer.
+    Every update averages the floating point entries into views of that buffer with a single
+    fused lerp, without copying the model first. Other entries (like BatchNorm's counters)
+    keep their latest value.
+
+    With `ema_decay=None`, this is the arithmetic mean of all states since the last reset,
+    otherwise an exponential moving average.
+    """
+
+    def __init__(self, ema_decay=None):
+        self.ema_decay = ema_decay
+        self.counter = 0
+        self._average = None  # the arena
+        self._views = None  # one view into the arena per float entry
+        self._keys = None
+        self._float_keys = None
+        self._dtypes = None
+        self._others = {}  # non-float entries
+
+    def add(self, state_dict):
+        """Add a model state to the average"""
+        if self._average is None:
+            self._allocate(state_dict)
+
+        self.counter += 1
+        values = [state_dict[key].float() for key in self._float_keys]  # no copy for float32
+        if self.counter == 1:
+            for view, value in zip(self._views, values):
+                view.copy_(value)
+        elif self.ema_decay is None:
+            torch._foreach_lerp_(self._views, values, 1.0 / self.counter)
+        else:
+            torch._foreach_lerp_(self._views, values, 1.0 - self.ema_decay)
+
+        for key in self._others:
+            self._others[key] = state_dict[key]
+
+    def value(self):
+        """The average as a state_dict, with views into the average buffer where possible"""
+        if self._average is None:
+            return None
+        state_dict = {}
+        views = dict(zip(self._float_keys, self._views))
+        for key in self._keys:
+            if key in self._others:
+                state_dict[key] = self._others[key].clone()
+            else:
+                dtype = self._dtypes[key]
+                state_dict[key] = views[key] if dtype == torch.float32 else views[key].to(dtype)
+        return state_dict
+
+    def reset(self):
+        """Start a new average, but keep the buffers"""
+        self.counter = 0
+
+    def state_dict(self):
+        return {"counter": self.counter, "average": self.value()}
+
+    def load_state_dict(self, state):
+        self.counter = 0
+        if state["average"] is not None:
+            self.add(state["average"])
+        self.counter = state["counter"]
+
+    def _allocate(self, state_dict):
+        self._keys = list(state_dict.keys())
+        self._float_keys = [key for key in self._keys if state_dict[key].is_floating_point()]
+        self._others = {key: None for key in self._keys if key not in self._float_keys}
+        self._dtypes = {key: state_dict[key].dtype for key in self._keys}
+
+        numel = sum(state_dict[key].nelement() for key in self._float_keys)
+        device = next(iter(state_dict.values())).device
+        self._average = torch.zeros(numel, dtype=torch.float32, device=device)
+        self._views = []
+        offset = 0
+        for key in self._float_keys:
+            shape = state_dict[key].shape
+            self._views.append(self._average[offset : offset + shape.numel()].view(shape))
+            offset += shape.numel()
+
+
+class MetricsAccumulator:
+    """
+    Average of a fixed set of scalar metrics (a dict of 0-dim tensors), kept on their device
+    as one tensor of weighted sums. Adding a batch never waits for the device.
+    Has the same interface as MeanAccumulator.
+    """
+
+    def __init__(self):
+        self._keys = None
+        self._sums = None
+        self._count = None
+        self.counter = 0
+
+    def add(self, metrics, weight=1.0):
+        """Add a dict of metrics to the average"""
+        if self._keys is None:
+            self._keys = list(metrics.keys())
+            device = metrics[self._keys[0]].device
+            self._sums = torch.zeros(len(self._keys), dtype=torch.float32, device=device)
+        values = torch.stack([torch.as_tensor(metrics[key]).float() for key in self._keys])
+        self._sums.add_(values.to(self._sums.device), alpha=weight)
+        self.counter += weight
+
+    def reduce(self):
+        """Reduce over workers, in one all-reduce of the sums and the count"""
+        if not torch.distributed.is_available() or torch.distributed.get_world_size() == 1:
+            return
+        if self._sums is None:
+            return
+        count = torch.tensor([float(self.counter)], device=self._sums.device)
+        buffer = torch.cat([self._sums, count])
+        torch.distributed.all_reduce(buffer)
+        self._sums = buffer[:-1]
+        self._count = buffer[-1]
+
+    def value(self):
+        """The averages as a dict of 0-dim tensors. Reading them synchronizes with the device."""
+        if self._keys is None:
+            return {}
+        count = self._count if self._count is not None else self.counter
+        averages = self._sums / count
+        return {key: averages[i] for i, key in enumerate(self._keys)}
+
+    def reset(self):
+        self._sums = None
+        self._keys = None
+        self._count = None
+        self.counter = 0
+
+
+class DeferredMetrics:
+    """
+    Drop-in for a metric log function whose values may be tensors on the device.
+    The metrics are only logged on `flush()`, with a single transfer to the host.
+    """
+
+    def __init__(self, log_fn):
+        self.log_fn = log_fn
+        self._pending = []
+
+    def __call__(self, name, values, tags={}):
+        self._pending.append((name, values, tags))
+
+    def flush(self):
+        tensors = [
+            value
+            for _, values, _ in self._pending
+            for value in values.values()
+            if isinstance(value, torch.Tensor)
+        ]
+        if len(tensors) > 0:
+            device = tensors[0].device
+            host_values = iter(
+                torch.stack([t.detach().float().reshape([]).to(device) for t in tensors]).tolist()
+            )
+        for name, values, tags in self._pending:
+            values = {
+                key: next(host_values) if isinstance(value, torch.Tensor) else value
+                for key, value in values.items()
+            }
+            self.log_fn(name, values, tags)
+        self._pending = []
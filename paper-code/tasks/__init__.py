@@ -7,13 +7,19 @@ def build(task_name, seed, device, timer, **kwargs):
             device=device,
             timer=timer,
             architecture=kwargs.get("task_architecture", "ResNet18"),
+            dataset=kwargs.get("task_cifar_dataset", "torchvision"),
+            num_prefetch=kwargs.get("task_num_prefetch_batches", 0),
         )
 
     elif task_name == "LanguageModeling":
         from .language_modeling import LanguageModelingTask
 
         return LanguageModelingTask(
-            seed=seed, device=device, timer=timer, batch_size=kwargs.get("optimizer_batch_size")
+            seed=seed,
+            device=device,
+            timer=timer,
+            batch_size=kwargs.get("optimizer_batch_size"),
+            num_prefetch=kwargs.get("task_num_prefetch_batches", 0),
         )
 
     else:
@@ -1,13 +1,15 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from typing import Dict, Iterable, List
 
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 import torchvision
 
-from mean_accumulator import MeanAccumulator
-from .utils import DistributedSampler
+from mean_accumulator import MetricsAccumulator
+from .utils import DistributedSampler, Prefetcher
 from . import cifar_architectures
 
 
@@ -17,22 +19,48 @@ class Batch:
         self.y = y
 
 
+DATA_MEAN = (0.4914, 0.4822, 0.4465)
+DATA_STDDEV = (0.2023, 0.1994, 0.2010)
+
+
 class CifarTask:
-    def __init__(self, device, timer, architecture, seed):
+    def __init__(self, device, timer, architecture, seed, dataset="torchvision", num_prefetch=0):
+        """
+        With dataset="mmap", the training set is stored once as a memory-mapped uint8 array,
+        and batches are cropped, flipped and normalized as a whole (see MemoryMappedBatchLoader).
+        With "torchvision", every sample goes through torchvision's PIL transforms.
+        With num_prefetch > 0, a background thread prepares that many training batches ahead.
+        """
         self._device = device
         self._timer = timer
         self._seed = seed
         self._architecture = architecture
-
-        self._train_set, self._test_set = self._create_dataset(
-            data_root=os.path.join(os.getenv("DATA"), "data")
-        )
+        self._dataset = dataset
+        self._num_prefetch = num_prefetch
+
+        data_root = os.path.join(os.getenv("DATA"), "data")
+        if dataset == "mmap":
+            self._train_images, self._train_labels = load_memory_mapped_dataset(
+                data_root, lambda: self._create_dataset(data_root=data_root, train=True)
+            )
+            self._train_set = self._train_labels  # the sampler only needs its length
+        elif dataset == "torchvision":
+            self._train_set = self._create_dataset(data_root=data_root, train=True)
+        else:
+            raise ValueError(f"Unknown Cifar dataset mode {dataset}")
+        self._test_set = self._create_dataset(data_root=data_root, train=False)
 
         self._model = self._create_model()
         self._criterion = torch.nn.CrossEntropyLoss().to(self._device)
 
         self._epoch = 0  # Counts how many times train_iterator was called
 
+        # Created on first use, and reused for every evaluation
+        self._test_model = None
+        self._test_loader = None
+        self._test_executor = None
+        self._pending_test = None  # a background evaluation that may still use the test model
+
     @property
     def state(self):
         return [parameter for parameter in self._model.parameters()]
@@ -45,14 +73,31 @@ class CifarTask:
     def parameter_names(self):
         return [name for (name, _) in self._model.named_parameters()]
 
-    def train_iterator(self, batch_size: int) -> Iterable[Batch]:
+    def train_iterator(self, batch_size: int, start_batch: int = 0) -> Iterable[Batch]:
         """Create a dataloader serving `Batch`es from the training dataset.
+        With `start_batch`, the epoch is resumed from that batch.
         Example:
             >>> for batch in task.train_iterator(batch_size=32):
             ...     batch_loss, gradients = task.batchLossAndGradient(batch)
         """
         sampler = DistributedSampler(dataset=self._train_set, add_extra_samples=True)
         sampler.set_epoch(self._epoch)
+        sampler.set_start_index(start_batch * batch_size)
+
+        if self._dataset == "mmap":
+            rank = torch.distributed.get_rank() if torch.distributed.is_available() else 0
+            generator = torch.Generator().manual_seed(self._seed + 1000 * self._epoch + rank)
+            self._epoch += 1
+            return self._prefetch(
+                MemoryMappedBatchLoader(
+                    self._train_images,
+                    self._train_labels,
+                    sampler,
+                    batch_size,
+                    self._device,
+                    generator=generator,
+                )
+            )
 
         train_loader = DataLoader(
             self._train_set,
@@ -65,14 +110,16 @@ class CifarTask:
 
         self._epoch += 1
 
-        return BatchLoader(train_loader, self._device)
+        return self._prefetch(
+            BatchLoader(train_loader, self._device, num_reused_batches=self._num_reused_batches())
+        )
 
-    def batch_loss(self, batch: Batch) -> (float, Dict[str, float]):
+    def batch_loss(self, batch: Batch) -> (torch.Tensor, Dict[str, float]):
         """
         Evaluate the loss on a batch.
         If the model has batch normalization or dropout, this will run in training mode.
         Returns:
-            - loss function (float)
+            - loss function (0-dim tensor on the device)
             - bunch of metrics (dictionary)
         """
         with torch.no_grad():
@@ -81,7 +128,7 @@ class CifarTask:
                 loss = self._criterion(prediction, batch.y)
             with self._timer("batch.evaluate", float(self._epoch)):
                 metrics = self.evaluate_prediction(prediction, batch.y)
-        return loss.item(), metrics
+        return loss.detach(), metrics
 
     def batch_loss_and_gradient(
         self, batch: Batch
@@ -127,17 +174,16 @@ class CifarTask:
         The task is completed as soon as the output is below self.target_test_loss.
         If the model has batch normalization or dropout, this will run in eval mode.
         """
-        test_loader = BatchLoader(
-            DataLoader(
-                self._test_set,
-                batch_size=250,
-                num_workers=1,
-                drop_last=False,
-                pin_memory=True,
-                sampler=DistributedSampler(dataset=self._test_set, add_extra_samples=False),
-            ),
-            self._device,
-        )
+        return self.test_in_background(state_dict, background=False).result()
+
+    def test_in_background(self, state_dict=None, background=True) -> "PendingTest":
+        """
+        Start evaluating `state_dict` on the test set in a background thread, while training
+        continues. The weights are copied before this returns.
+        All workers need to call `.result()` on the returned object in the same order as
+        their other collective operations, because that reduces the metrics over workers.
+        """
+        self._wait_for_pending_test()
 
         if state_dict:
             test_model = self._create_test_model(state_dict)
@@ -145,22 +191,75 @@ class CifarTask:
             test_model = self._model
             test_model.eval()
 
-        mean_metrics = MeanAccumulator()
-
-        for batch in test_loader:
+        if not background:
+            return PendingTest(self._evaluate(test_model))
+
+        if self._test_executor is None:
+            self._test_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_test = PendingTest(self._test_executor.submit(self._evaluate, test_model))
+        return self._pending_test
+
+    def _evaluate(self, test_model):
+        if self._test_loader is None:
+            self._test_loader = BatchLoader(
+                DataLoader(
+                    self._test_set,
+                    batch_size=250,
+                    num_workers=1,
+                    drop_last=False,
+                    pin_memory=True,
+                    persistent_workers=True,
+                    sampler=DistributedSampler(dataset=self._test_set, add_extra_samples=False),
+                    # Not the global generator, so that evaluation doesn't change training
+                    generator=torch.Generator().manual_seed(self._seed),
+                ),
+                self._device,
+            )
+
+        mean_metrics = MetricsAccumulator()
+
+        for batch in self._test_loader:
             with torch.no_grad():
                 prediction = test_model(batch.x)
                 metrics = self.evaluate_prediction(prediction, batch.y)
             mean_metrics.add(metrics)
-        mean_metrics.reduce()  # Collect over workers
 
         test_model.train()
-        return mean_metrics.value()
+        return mean_metrics
+
+    def _wait_for_pending_test(self):
+        if self._pending_test is not None:
+            self._pending_test.wait()
+            self._pending_test = None
 
     def state_dict(self):
         """Dictionary containing the model state (buffers + tensors)"""
         return self._model.state_dict()
 
+    def load_state_dict(self, state_dict):
+        self._model.load_state_dict(state_dict)
+
+    def train_state_dict(self):
+        """Progress through the training data, to resume training from a checkpoint"""
+        return {"epoch": self._epoch}
+
+    def load_train_state_dict(self, state):
+        self._epoch = state["epoch"]
+
+    def _prefetch(self, loader):
+        if self._num_prefetch == 0:
+            return loader
+        return Prefetcher(loader, self._num_prefetch, self._timer)
+
+    def _num_reused_batches(self):
+        """
+        With prefetching, device memory of old batches can be reused: there are at most
+        `num_prefetch` batches in the queue, one in the producer and one in training.
+        """
+        if self._num_prefetch == 0 or self._device.type != "cuda":
+            return 0
+        return self._num_prefetch + 2
+
     def _create_model(self):
         """Create a PyTorch module for the model"""
         torch.random.manual_seed(self._seed)
@@ -170,17 +269,18 @@ class CifarTask:
         return model
 
     def _create_test_model(self, state_dict):
-        test_model = deepcopy(self._model)
-        test_model.load_state_dict(state_dict)
-        test_model.eval()
-        return test_model
-
-    def _create_dataset(self, data_root="./data"):
-        """Create train and test datasets"""
+        if self._test_model is None:
+            self._test_model = deepcopy(self._model)
+        self._test_model.load_state_dict(state_dict)
+        self._test_model.eval()
+        return self._test_model
+
+    def _create_dataset(self, data_root="./data", train=True):
+        """Create the train or the test dataset"""
         dataset = torchvision.datasets.CIFAR10
 
-        data_mean = (0.4914, 0.4822, 0.4465)
-        data_stddev = (0.2023, 0.1994, 0.2010)
+        data_mean = DATA_MEAN
+        data_stddev = DATA_STDDEV
 
         transform_train = torchvision.transforms.Compose(
             [
@@ -198,31 +298,149 @@ class CifarTask:
             ]
         )
 
-        training_set = dataset(root=data_root, train=True, download=True, transform=transform_train)
-        test_set = dataset(root=data_root, train=False, download=True, transform=transform_test)
-
-        return training_set, test_set
+        if train:
+            return dataset(root=data_root, train=True, download=True, transform=transform_train)
+        else:
+            return dataset(root=data_root, train=False, download=True, transform=transform_test)
 
     def _zero_grad(self):
         self._model.zero_grad()
 
 
+class PendingTest:
+    """Result of CifarTask.test_in_background"""
+
+    def __init__(self, mean_metrics):
+        self._mean_metrics = mean_metrics  # a MetricsAccumulator or a future of one
+        self._reduced = False
+
+    def wait(self):
+        """Wait for the evaluation to finish, without reducing over workers"""
+        if not isinstance(self._mean_metrics, MetricsAccumulator):
+            self._mean_metrics = self._mean_metrics.result()
+
+    def result(self) -> Dict[str, torch.Tensor]:
+        """Test metrics averaged over workers"""
+        self.wait()
+        if not self._reduced:
+            self._mean_metrics.reduce()  # Collect over workers
+            self._reduced = True
+        return self._mean_metrics.value()
+
+
 class BatchLoader:
     """
     Utility that transforms a DataLoader that is an iterable over (x, y) tuples
     into an iterable over Batch() tuples, where its contents are already moved
     to the selected device.
+    With `num_reused_batches` > 0, the device tensors of a Batch are overwritten again
+    that many batches later, so the consumer should not hold on to them for longer.
     """
 
-    def __init__(self, dataloader, device):
+    def __init__(self, dataloader, device, num_reused_batches=0):
         self._dataloader = dataloader
         self._device = device
+        self._reused_batches = [None] * num_reused_batches
 
     def __len__(self):
         return len(self._dataloader)
 
     def __iter__(self):
-        for x, y in self._dataloader:
-            x = x.to(self._device)
-            y = y.to(self._device)
-            yield Batch(x, y)
+        for i, (x, y) in enumerate(self._dataloader):
+            if len(self._reused_batches) == 0:
+                x = x.to(self._device, non_blocking=True)
+                y = y.to(self._device, non_blocking=True)
+                yield Batch(x, y)
+                continue
+
+            slot = i % len(self._reused_batches)
+            batch = self._reused_batches[slot]
+            if batch is None or batch.x.shape != x.shape or batch.y.shape != y.shape:
+                batch = Batch(
+                    torch.empty_like(x, device=self._device),
+                    torch.empty_like(y, device=self._device),
+                )
+                self._reused_batches[slot] = batch
+            # The DataLoader pins the memory, so these copies are asynchronous
+            batch.x.copy_(x, non_blocking=True)
+            batch.y.copy_(y, non_blocking=True)
+            yield batch
+
+
+def load_memory_mapped_dataset(data_root, create_dataset, split="train"):
+    """
+    Memory-map the images (uint8, NHWC) and labels of a torchvision CIFAR dataset.
+    They are written to `data_root` the first time, from the dataset that `create_dataset()`
+    returns. Once they exist, the torchvision dataset is not loaded at all.
+    """
+    paths = {
+        "images": os.path.join(data_root, f"cifar10_{split}_images.npy"),
+        "labels": os.path.join(data_root, f"cifar10_{split}_labels.npy"),
+    }
+    if not all(os.path.exists(path) for path in paths.values()):
+        dataset = create_dataset()
+        arrays = {
+            "images": np.asarray(dataset.data, dtype=np.uint8),
+            "labels": np.asarray(dataset.targets, dtype=np.int64),
+        }
+        for key, path in paths.items():
+            if not os.path.exists(path):
+                # Workers may do this at the same time, so write to a private file first
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                np.save(tmp_path, arrays[key])
+                os.replace(tmp_path + ".npy", path)
+    return np.load(paths["images"], mmap_mode="r"), np.load(paths["labels"], mmap_mode="r")
+
+
+class MemoryMappedBatchLoader:
+    """
+    Serves augmented training `Batch`es from memory-mapped uint8 images.
+    Random crops (with 4 pixels of zero padding) and horizontal flips are one gather
+    over the whole batch, followed by normalization, instead of PIL transforms per sample.
+    """
+
+    def __init__(self, images, labels, sampler, batch_size, device, generator=None, padding=4):
+        self._images = images
+        self._labels = labels
+        self._sampler = sampler
+        self._batch_size = batch_size
+        self._device = device
+        self._generator = generator
+        self._padding = padding
+
+        self._mean = torch.tensor(DATA_MEAN, device=device).view(1, 3, 1, 1) * 255
+        self._stddev = torch.tensor(DATA_STDDEV, device=device).view(1, 3, 1, 1) * 255
+
+    def __len__(self):
+        return len(self._sampler) // self._batch_size  # drop_last
+
+    def __iter__(self):
+        indices = self._sampler.indices().numpy()
+        for i in range(len(self)):
+            batch_indices = indices[i * self._batch_size : (i + 1) * self._batch_size]
+            # Reading in sorted order is friendlier to the page cache
+            order = np.argsort(batch_indices)
+            images = np.empty((len(batch_indices),) + self._images.shape[1:], dtype=np.uint8)
+            images[order] = self._images[batch_indices[order]]
+            x = self.augment(torch.from_numpy(images))
+            y = torch.from_numpy(np.asarray(self._labels[batch_indices]))
+            yield Batch(self.normalize(x.to(self._device)), y.to(self._device))
+
+    def augment(self, images):
+        """Random crop and horizontal flip of a batch of uint8 NHWC images, returns NCHW"""
+        n, height, width, _ = images.shape
+        p = self._padding
+        padded = torch.nn.functional.pad(images, (0, 0, p, p, p, p))
+
+        offset_y = torch.randint(0, 2 * p + 1, (n, 1), generator=self._generator)
+        offset_x = torch.randint(0, 2 * p + 1, (n, 1), generator=self._generator)
+        flip = torch.rand((n, 1), generator=self._generator) < 0.5
+        rows = offset_y + torch.arange(height)
+        cols = torch.arange(width).expand(n, width)
+        cols = offset_x + torch.where(flip, width - 1 - cols, cols)
+
+        crops = padded[torch.arange(n)[:, None, None], rows[:, :, None], cols[:, None, :]]
+        return crops.permute(0, 3, 1, 2)
+
+    def normalize(self, images):
+        return (images.float() - self._mean) / self._stddev
@@ -1,16 +1,15 @@
+import math
 import os
 from copy import deepcopy
 from typing import Dict, Iterable, List
 
-import spacy
 import torch
-import torchtext
-from spacy.symbols import ORTH
 from torch.utils.data import DataLoader
 
-from mean_accumulator import MeanAccumulator
+from mean_accumulator import MetricsAccumulator
 
-from ..utils import DistributedSampler
+from ..utils import DistributedSampler, Prefetcher
+from .corpus import SPLITS, load_tokenized_corpus
 from .model import RNNModel
 
 
@@ -26,12 +25,13 @@ STOI = None  # string to integer
 
 
 class LanguageModelingTask:
-    def __init__(self, device, timer, seed, batch_size):
+    def __init__(self, device, timer, seed, batch_size, num_prefetch=0):
         self._device = device
         self._timer = timer
         self._batch_size = batch_size
         self._seed = seed
         self._epoch = 0
+        self._num_prefetch = num_prefetch  # training batches prepared ahead in a background thread
 
         torch.random.manual_seed(self._seed)
         self.text, self.train_loader, self.val_loader = define_dataset(
@@ -70,23 +70,22 @@ class LanguageModelingTask:
             ...     batch_loss, gradients = task.batchLossAndGradient(batch)
         """
         self._epoch += 1
-        rank = torch.distributed.get_rank() if torch.distributed.is_available() else 1
         self._hidden_container["hidden"] = self._model.init_hidden(batch_size)
         return SplitBatchLoader(
             self.train_loader,
             self._device,
-            rank,
-            batch_size,
             model=self._model,
             hidden_container=self._hidden_container,
+            num_prefetch=self._num_prefetch,
+            timer=self._timer,
         )
 
-    def batch_loss(self, batch: Batch) -> (float, Dict[str, float]):
+    def batch_loss(self, batch: Batch) -> (torch.Tensor, Dict[str, float]):
         """
         Evaluate the loss on a batch.
         If the model has batch normalization or dropout, this will run in training mode.
         Returns:
-            - loss function (float)
+            - loss function (0-dim tensor on the device)
             - bunch of metrics (dictionary)
         """
         with torch.no_grad():
@@ -98,7 +97,7 @@ class LanguageModelingTask:
                 )
             with self._timer("batch.evaluate", float(self._epoch)):
                 metrics = self.evaluate_prediction(prediction, batch.y)
-        return loss.item(), metrics
+        return loss.detach(), metrics
 
     def batch_loss_and_gradient(
         self, batch: Batch, rnn_clip=0.4
@@ -145,14 +144,10 @@ class LanguageModelingTask:
         The task is completed as soon as the output is below self.target_test_loss.
         If the model has batch normalization or dropout, this will run in eval mode.
         """
-        rank = torch.distributed.get_rank() if torch.distributed.is_available() else 1
-
         self._hidden_container["hidden"] = self._model.init_hidden(self._batch_size)
         test_loader = SplitBatchLoader(
             self.val_loader,
             self._device,
-            rank,
-            batch_size=self._batch_size,
             model=self._model,
             hidden_container=self._hidden_container,
         )
@@ -163,7 +158,7 @@ class LanguageModelingTask:
             test_model = self._model
             test_model.eval()
 
-        mean_metrics = MeanAccumulator()
+        mean_metrics = MetricsAccumulator()
 
         for batch in test_loader:
             with torch.no_grad():
@@ -180,6 +175,16 @@ class LanguageModelingTask:
         """Dictionary containing the model state (buffers + tensors)"""
         return self._model.state_dict()
 
+    def load_state_dict(self, state_dict):
+        self._model.load_state_dict(state_dict)
+
+    def train_state_dict(self):
+        """Progress through the training data, to resume training from a checkpoint"""
+        return {"epoch": self._epoch}
+
+    def load_train_state_dict(self, state):
+        self._epoch = state["epoch"]
+
     def _create_model(self):
         """Create a PyTorch module for the model"""
         torch.random.manual_seed(self._seed)
@@ -200,78 +205,126 @@ class LanguageModelingTask:
 
 class SplitBatchLoader:
     """
-    Utility that transforms a DataLoader that is an iterable over (x, y) tuples
-    into an iterable over Batch() tuples, where its contents are already moved
-    to the selected device.
+    Utility that transforms a BPTTLoader that is an iterable over (text, target) batches
+    of this worker's columns into an iterable over Batch() tuples with the hidden state.
     """
 
-    def __init__(self, dataloader, device, rank, batch_size, model, hidden_container):
+    def __init__(
+        self,
+        dataloader,
+        device,
+        model,
+        hidden_container,
+        num_prefetch=0,
+        timer=None,
+    ):
         self._dataloader = dataloader
         self._device = device
-        self._rank = rank
-        self._batch_size = batch_size
         self._model = model
         self._hidden_container = hidden_container
+        self._num_prefetch = num_prefetch
+        self._timer = timer
 
     def __len__(self):
         return len(self._dataloader)
 
     def __iter__(self):
-        for i, batch in enumerate(self._dataloader):
-            # if i == 0:
-            #     print("Data signature", batch.text.view(-1)[0:5].numpy())
-            x = batch.text[:, self._rank * self._batch_size : (self._rank + 1) * self._batch_size]
-            y = batch.target[:, self._rank * self._batch_size : (self._rank + 1) * self._batch_size]
+        inputs = self._inputs()
+        if self._num_prefetch > 0:
+            inputs = Prefetcher(inputs, self._num_prefetch, self._timer)
+        for x, y in inputs:
+            # The hidden state depends on the previous batch, so it can't be prefetched
             hidden = self._model.repackage_hidden(self._hidden_container["hidden"])
             yield Batch(x, y, hidden)
 
-
-def define_dataset(
-    device,
-    dataset_name,
-    dataset_path,
-    batch_size,
-    rnn_use_pretrained_emb=False,
-    rnn_n_hidden=650,
-    reshuffle_per_epoch=True,
-    rnn_bptt_len=30,
-):
-    # create dataset.
-    TEXT, train, valid, test = _get_dataset(dataset_name, dataset_path)
+    def _inputs(self):
+        for i, batch in enumerate(self._dataloader):
+            # if i == 0:
+            #     print("Data signature", batch.text.view(-1)[0:5].numpy())
+            yield batch.text, batch.target
+
+
+def define_dataset(device, dataset_name, dataset_path, batch_size, rnn_bptt_len=30):
+    # Tokenize once, and afterwards only read the cached token ids
+    rank = torch.distributed.get_rank() if torch.distributed.is_available() else 0
+    if rank != 0:
+        torch.distributed.barrier()  # let worker 0 create the cache first
+    corpus = load_tokenized_corpus(
+        dataset_name,
+        dataset_path,
+        tokenizer_name="spacy-en-lower",
+        tokenize_fn=lambda: _tokenize_dataset(dataset_name, dataset_path),
+    )
+    if rank == 0 and torch.distributed.is_available():
+        torch.distributed.barrier()
 
     n_workers = torch.distributed.get_world_size() if torch.distributed.is_available() else 1
 
-    # Build vocb.
-    # we can use some precomputed word embeddings,
-    # e.g., GloVe vectors with 100, 200, and 300.
-    if rnn_use_pretrained_emb:
-        try:
-            vectors = "glove.6B.{}d".format(rnn_n_hidden)
-            vectors_cache = os.path.join(dataset_path, ".vector_cache")
-        except:
-            vectors, vectors_cache = None, None
-    else:
-        vectors, vectors_cache = None, None
-    TEXT.build_vocab(train, vectors=vectors, vectors_cache=vectors_cache)
-
-    # Partition training data.
-    train_loader, _ = torchtext.data.BPTTIterator.splits(
-        (train, valid),
+    # Partition training data: every worker only loads its own columns of the global batch
+    train_loader = BPTTLoader(
+        corpus.splits["train"],
         batch_size=batch_size * n_workers,
         bptt_len=rnn_bptt_len,
         device=device,
-        shuffle=reshuffle_per_epoch,
+        pad_index=corpus.vocab.pad_index,
+        shard=rank,
+        num_shards=n_workers,
     )
-    _, val_loader = torchtext.data.BPTTIterator.splits(
-        (train, valid),
+    val_loader = BPTTLoader(
+        corpus.splits["valid"],
         batch_size=batch_size * n_workers,
         bptt_len=rnn_bptt_len,
         device=device,
-        shuffle=reshuffle_per_epoch,
+        pad_index=corpus.vocab.pad_index,
+        shard=rank,
+        num_shards=n_workers,
     )
 
     # get some stat.
-    return TEXT, train_loader, val_loader
+    return corpus, train_loader, val_loader
+
+
+class BPTTLoader:
+    """
+    Serves the same batches of (text, target) as torchtext's BPTTIterator,
+    from an array of token ids.
+    The stream is padded to a multiple of the (global) batch size, and split into
+    `batch_size` contiguous columns, which are served `bptt_len` tokens at a time.
+    The columns are divided over `num_shards` workers. Because every column is a contiguous
+    range of the token stream, a worker only reads its own part of the array.
+    """
+
+    def __init__(self, token_ids, batch_size, bptt_len, device, pad_index, shard=0, num_shards=1):
+        assert batch_size % num_shards == 0
+        self._token_ids = token_ids
+        self._batch_size = batch_size
+        self._bptt_len = bptt_len
+        self._device = device
+        self._pad_index = pad_index
+        self._shard = shard
+        self._num_columns = batch_size // num_shards
+
+    def __len__(self):
+        return math.ceil((len(self._token_ids) / self._batch_size - 1) / self._bptt_len)
+
+    def __iter__(self):
+        column_length = math.ceil(len(self._token_ids) / self._batch_size)
+        start = self._shard * self._num_columns * column_length
+        tokens = self._token_ids[start : start + self._num_columns * column_length]
+
+        data = torch.full([self._num_columns * column_length], self._pad_index, dtype=torch.long)
+        data[: len(tokens)] = torch.from_numpy(tokens.astype("int64"))
+        data = data.view(self._num_columns, column_length).t().contiguous().to(self._device)
+
+        for i in range(0, len(self) * self._bptt_len, self._bptt_len):
+            seq_len = min(self._bptt_len, column_length - i - 1)
+            yield TextBatch(text=data[i : i + seq_len], target=data[i + 1 : i + 1 + seq_len])
+
+
+class TextBatch:
+    def __init__(self, text, target):
+        self.text = text
+        self.target = target
 
 
 def define_model(TEXT, rnn_n_hidden=650, rnn_n_layers=3, rnn_tie_weights=True, drop_rate=0.4):
@@ -302,6 +355,10 @@ def define_model(TEXT, rnn_n_hidden=650, rnn_n_layers=3, rnn_tie_weights=True, d
 
 
 def _get_text():
+    import spacy
+    import torchtext
+    from spacy.symbols import ORTH
+
     spacy_en = spacy.load("en")
     spacy_en.tokenizer.add_special_case("<eos>", [{ORTH: "<eos>"}])
     spacy_en.tokenizer.add_special_case("<bos>", [{ORTH: "<bos>"}])
@@ -315,6 +372,8 @@ def _get_text():
 
 
 def _get_dataset(name, datasets_path):
+    import torchtext
+
     TEXT = _get_text()
 
     # Load and split data.
@@ -323,3 +382,14 @@ def _get_dataset(name, datasets_path):
     elif "ptb" in name:
         train, valid, test = torchtext.datasets.PennTreebank.splits(TEXT, root=datasets_path)
     return TEXT, train, valid, test
+
+
+def _tokenize_dataset(name, datasets_path):
+    """Tokenize the splits of a dataset like torchtext's BPTTIterator would, for the cache"""
+    TEXT, train, valid, test = _get_dataset(name, datasets_path)
+    TEXT.build_vocab(train)
+    token_ids = {
+        split: TEXT.numericalize([dataset[0].text]).view(-1).tolist()
+        for split, dataset in zip(SPLITS, [train, valid, test])
+    }
+    return TEXT.vocab.itos, TEXT.vocab.stoi[TEXT.pad_token], token_ids
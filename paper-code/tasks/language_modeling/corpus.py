@@ -0,0 +1,103 @@
+"""
+Cache of tokenized corpora: the token ids of every split as a memory-mapped .npy array
+(uint16 if the vocabulary allows, otherwise uint32), and the vocabulary as JSON.
+The cache is keyed on a hash of the raw text files and the tokenizer, so tokenization
+only runs once, and again only if one of them changes.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_VERSION = 1
+SPLITS = ["train", "valid", "test"]
+
+# Where torchtext downloads the raw text of each split, relative to the dataset path
+RAW_FILES = {
+    "wikitext2": [
+        os.path.join("wikitext-2", "wikitext-2", f"wiki.{split}.tokens") for split in SPLITS
+    ],
+    "ptb": [os.path.join("penn-treebank", f"ptb.{split}.txt") for split in SPLITS],
+}
+
+
+class Vocabulary:
+    """The parts of torchtext's Vocab that the language modeling task uses"""
+
+    def __init__(self, itos, pad_index):
+        self.itos = itos
+        self.stoi = {token: index for index, token in enumerate(itos)}
+        self.pad_index = pad_index
+        self.vectors = None  # no pretrained embeddings
+
+    def __len__(self):
+        return len(self.itos)
+
+
+class TokenizedCorpus:
+    """Memory-mapped token ids per split (in `splits`), and the `vocab`"""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "vocab.json"), "r") as fp:
+            vocab = json.load(fp)
+        self.vocab = Vocabulary(vocab["itos"], vocab["pad_index"])
+        self.splits = {
+            split: np.load(os.path.join(directory, f"{split}.npy"), mmap_mode="r")
+            for split in SPLITS
+        }
+
+
+def load_tokenized_corpus(dataset_name, dataset_path, tokenizer_name, tokenize_fn):
+    """
+    Load the tokenized corpus from the cache, after creating it if needed.
+    `tokenize_fn()` downloads and tokenizes the raw corpus. It returns the vocabulary
+    as a list of strings, the index of the padding token and a dict of token id lists
+    for the splits.
+    """
+    key = cache_key(dataset_name, dataset_path, tokenizer_name)
+    directory = os.path.join(dataset_path, "tokenized", key)
+    if not os.path.exists(os.path.join(directory, "vocab.json")):
+        itos, pad_index, token_ids = tokenize_fn()
+        # The raw files exist now, and the key might have been computed without them
+        key = cache_key(dataset_name, dataset_path, tokenizer_name)
+        directory = os.path.join(dataset_path, "tokenized", key)
+        write_tokenized_corpus(directory, itos, pad_index, token_ids)
+    return TokenizedCorpus(directory)
+
+
+def write_tokenized_corpus(directory, itos, pad_index, token_ids):
+    os.makedirs(directory, exist_ok=True)
+    dtype = np.uint16 if len(itos) <= np.iinfo(np.uint16).max + 1 else np.uint32
+    for split in SPLITS:
+        array = np.asarray(token_ids[split], dtype=dtype)
+        _atomic_save(os.path.join(directory, f"{split}.npy"), array)
+
+    # vocab.json is written last, its presence marks a complete cache
+    tmp_path = os.path.join(directory, f"vocab.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump({"itos": itos, "pad_index": pad_index}, fp)
+    os.replace(tmp_path, os.path.join(directory, "vocab.json"))
+
+
+def cache_key(dataset_name, dataset_path, tokenizer_name):
+    """Hash of the raw text files (if they are there) and of how they are tokenized"""
+    sha = hashlib.sha256()
+    sha.update(f"{CACHE_VERSION}:{dataset_name}:{tokenizer_name}".encode())
+    for raw_file in RAW_FILES[dataset_name]:
+        path = os.path.join(dataset_path, raw_file)
+        if not os.path.exists(path):
+            sha.update(b"missing")
+            continue
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+def _atomic_save(path, array):
+    # Workers may do this at the same time, so write to a private file first
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    np.save(tmp_path, array)
+    os.replace(tmp_path + ".npy", path)
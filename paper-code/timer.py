@@ -1,9 +1,11 @@
 import time
 import json
+import math
+import random
+import threading
 from contextlib import contextmanager
 from io import StringIO
 
-import numpy as np
 import torch
 
 NS = 1.0 / 1_000_000_000  # 1[ns] in [s]
@@ -20,23 +22,84 @@ class Timer:
     ...     with timer("expensive operation"):
     ...         x = torch.randn(100)
     ... print(timer.summary())
+
+    With `buffer_size > 0`, the timer runs in a low-overhead mode: events are only written
+    to a preallocated ring buffer of (label-id, start, end, epoch, thread) records, and a background
+    thread folds them into the totals and logs every `flush_interval` seconds.
+    Any thread can record events, writes to the buffer are serialized with a lock.
+    The totals, histograms and spans are only changed and read while holding another lock,
+    so summaries can be taken while the background thread flushes.
+    Set `cuda_sync=False` to not wait for the GPU around every event. Timings then only
+    include the time to launch kernels, but the training loop keeps its asynchrony.
+
+    With `trace=True`, the timer also keeps every region as a span, and `save_trace`
+    writes them as a Chrome trace (chrome://tracing or ui.perfetto.dev). Spans are
+    timestamped on the wall clock, with `rank` as process id, so the files of all
+    workers can be combined with `merge_traces`.
+
+    Durations are also counted in a `LogHistogram` per label, for percentiles.
     """
 
-    def __init__(self, verbosity_level=1, log_fn=None, skip_first=True):
+    def __init__(
+        self,
+        verbosity_level=1,
+        log_fn=None,
+        skip_first=True,
+        cuda_sync=True,
+        buffer_size=0,
+        flush_interval=1.0,
+        trace=False,
+        rank=0,
+    ):
         self.verbosity_level = verbosity_level
         self.log_fn = log_fn if log_fn is not None else self._default_log_fn
         self.skip_first = skip_first
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.trace = trace
+        self.rank = rank
+        # Converts perf_counter_ns to wall-clock time, so traces of different workers line up
+        self._wall_clock_offset_ns = time.time_ns() - time.perf_counter_ns()
+
+        self._label_ids = {}  # label -> index into self._labels
+        self._labels = []
+        # Guards the totals, histograms and spans. Reentrant, because readers flush first
+        self._flush_lock = threading.RLock()
+        # Events come from several threads (the training loop, data prefetching, checkpoint writing)
+        self._record_lock = threading.Lock()
+        self._flush_thread = None
+        self._stop_flushing = threading.Event()
 
         self.reset()
 
+        if buffer_size > 0:
+            self._flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flush_thread.start()
+
     def reset(self):
         """Reset the timer"""
-        self.totals = {}  # Total time per label
-        self.first_time = {}  # First occurrence of a label (start time)
-        self.last_time = {}  # Last occurence of a label (end time)
-        self.call_counts = {}  # Number of times a label occurred
+        with self._flush_lock, self._record_lock:
+            self.totals = {}  # Total time per label
+            self.first_time = {}  # First occurrence of a label (start time)
+            self.last_time = {}  # Last occurence of a label (end time)
+            self.call_counts = {}  # Number of times a label occurred
+            self.histograms = {}  # Distribution of the durations per label
+            self._histograms_at_last_exchange = {}  # label -> counts, see find_stragglers
+
+            # Ring buffer of events that still need to be reported
+            self._events = [None] * self.buffer_size
+            self._num_written = 0
+            self._num_flushed = 0
+            self.num_dropped_events = 0  # overwritten before they were flushed
+
+            self.spans = []  # (label, start_ns, end_ns, thread id) if tracing
 
     def report(self, label, start, end):
+        with self._flush_lock:
+            self._report(label, start, end)
+
+    def _report(self, label, start, end):
         # Update first and last occurrence of this label
         if not label in self.first_time:
             self.first_time[label] = start
@@ -54,39 +117,81 @@ class Timer:
             self.totals[label] += end - start
             self.call_counts[label] += 1
 
+        if self.call_counts[label] > 0:
+            if label not in self.histograms:
+                self.histograms[label] = LogHistogram()
+            self.histograms[label].add(end - start)
+
+    def _log_sampled(self, label, start, end, epoch):
+        if self.call_counts[label] > 0:
+            # We will reduce the probability of logging a timing linearly with the number of times
+            # we have seen it.
+            # It will always be recorded in the totals, though
+            if random.random() < 1 / self.call_counts[label]:
+                self.log_fn(
+                    "timer", {"epoch": float(epoch), "value": end - start}, {"event": label}
+                )
 
-    @contextmanager
     def __call__(self, label, epoch=-1.0, verbosity=1):
         # Don't measure this if the verbosity level is too high
         if verbosity > self.verbosity_level:
-            yield
-            return
+            return _NULL_REGION
+        if self.buffer_size > 0:
+            return _BufferedRegion(self, self._label_id(label), epoch)
+        return self._timed_region(label, epoch)
 
+    @contextmanager
+    def _timed_region(self, label, epoch):
         # Measure the time
         self._cuda_sync()
-        start = time.time_ns() * NS
+        start = time.perf_counter_ns()
         yield
         self._cuda_sync()
-        end = time.time_ns() * NS
+        end = time.perf_counter_ns()
 
-        self.report(label, start, end)
+        with self._flush_lock:
+            self._report(label, start * NS, end * NS)
+            self._log_sampled(label, start * NS, end * NS, epoch)
+            if self.trace:
+                self.spans.append((label, start, end, threading.get_ident()))
 
-        if self.call_counts[label] > 0:
-            # We will reduce the probability of logging a timing linearly with the number of times
-            # we have seen it.
-            # It will always be recorded in the totals, though
-            if np.random.rand() < 1 / self.call_counts[label]:
-                self.log_fn(
-                    "timer", {"epoch": float(epoch), "value": end - start}, {"event": label}
-                )
+    def flush(self):
+        """Report all events in the ring buffer"""
+        with self._flush_lock:
+            # Copy the events first, producers may overwrite their slots once they wrap around
+            with self._record_lock:
+                num_written = self._num_written
+                first = max(self._num_flushed, num_written - self.buffer_size)
+                events = [self._events[i % self.buffer_size] for i in range(first, num_written)]
+            self.num_dropped_events += first - self._num_flushed
+            for label_id, start, end, epoch, thread_id in events:
+                label = self._labels[label_id]
+                self._report(label, start * NS, end * NS)
+                self._log_sampled(label, start * NS, end * NS, epoch)
+                if self.trace:
+                    self.spans.append((label, start, end, thread_id))
+            self._num_flushed = num_written
+
+    def close(self):
+        """Stop the background flushing and report the remaining events"""
+        if self._flush_thread is not None:
+            self._stop_flushing.set()
+            self._flush_thread.join()
+            self._flush_thread = None
+        self.flush()
 
     def summary(self):
         """
         Return a summary in string-form of all the timings recorded so far
         """
-        with StringIO() as buffer:
-            print("--- Timer summary -----------------------------------------------", file=buffer)
-            print("  Event                          |  Count | Average time |  Frac.", file=buffer)
+        with self._flush_lock, StringIO() as buffer:
+            self.flush()
+            print("--- Timer summary " + "-" * 89, file=buffer)
+            print(
+                "  Event                          |  Count | Average time |  Frac. |"
+                "       p50 |       p90 |       p99 |       max",
+                file=buffer,
+            )
             for event_label in sorted(self.totals):
                 total = self.totals[event_label]
                 count = self.call_counts[event_label]
@@ -95,34 +200,182 @@ class Timer:
                 avg_duration = total / count
                 total_runtime = self.last_time[event_label] - self.first_time[event_label]
                 runtime_percentage = 100 * total / total_runtime
+                percentiles = self.histograms[event_label].percentiles()
                 print(
-                    f"- {event_label:30s} | {count:6d} | {avg_duration:11.5f}s | {runtime_percentage:5.1f}%",
+                    f"- {event_label:30s} | {count:6d} | {avg_duration:11.5f}s | {runtime_percentage:5.1f}% | "
+                    + " | ".join(f"{percentiles[key]:8.5f}s" for key in ["p50", "p90", "p99", "max"]),
+                    file=buffer,
+                )
+            print("-" * 107, file=buffer)
+            if self.num_dropped_events > 0:
+                print(
+                    f"  {self.num_dropped_events} events were dropped, increase the buffer size",
                     file=buffer,
                 )
-            print("-----------------------------------------------------------------", file=buffer)
             return buffer.getvalue()
 
-    def save_summary(self, json_file_path):
+    def save_summary(self, json_file_path, cluster_percentiles=None):
+        """
+        Save the timings per label as JSON.
+        `cluster_percentiles` can hold the result of `cluster_percentiles()` to include.
+        """
         data = {}
-        for event_label in sorted(self.totals):
-            total = self.totals[event_label]
-            count = self.call_counts[event_label]
-            if count == 0:
-                continue
-            avg_duration = total / count
-            data[event_label] = {
-                "label": event_label,
-                "average_duration": avg_duration,
-                "n_events": count,
-                "total_time": total,
-            }
+        with self._flush_lock:
+            self.flush()
+            for event_label in sorted(self.totals):
+                total = self.totals[event_label]
+                count = self.call_counts[event_label]
+                if count == 0:
+                    continue
+                avg_duration = total / count
+                data[event_label] = {
+                    "label": event_label,
+                    "average_duration": avg_duration,
+                    "n_events": count,
+                    "total_time": total,
+                    **self.histograms[event_label].percentiles(),
+                }
+                if cluster_percentiles is not None and event_label in cluster_percentiles:
+                    data[event_label]["cluster"] = cluster_percentiles[event_label]
 
         with open(json_file_path, "w") as fp:
             json.dump(data, fp)
 
+    def cluster_percentiles(self):
+        """
+        Percentiles per label over the events of all workers, by summing their histograms.
+        This is a collective operation that all workers need to call.
+        """
+        import torch.distributed as dist
+
+        # Not holding the lock during collectives, the histograms are copied instead
+        with self._flush_lock:
+            self.flush()
+            histograms = {
+                label: (list(histogram.counts), histogram.max)
+                for label, histogram in self.histograms.items()
+            }
+        labels_per_worker = [None] * dist.get_world_size()
+        dist.all_gather_object(labels_per_worker, sorted(histograms))
+        labels = sorted(set().union(*labels_per_worker))
+
+        device = torch.device("cuda") if dist.get_backend() == "nccl" else torch.device("cpu")
+        counts = torch.zeros(len(labels), LogHistogram.NUM_BUCKETS, dtype=torch.float64)
+        maxima = torch.zeros(len(labels), dtype=torch.float64)
+        for i, label in enumerate(labels):
+            if label in histograms:
+                counts[i] = torch.tensor(histograms[label][0], dtype=torch.float64)
+                maxima[i] = histograms[label][1]
+        counts, maxima = counts.to(device), maxima.to(device)
+        dist.all_reduce(counts)
+        dist.all_reduce(maxima, op=dist.ReduceOp.MAX)
+
+        cluster_percentiles = {}
+        for i, label in enumerate(labels):
+            histogram = LogHistogram()
+            histogram.counts = [int(count) for count in counts[i].tolist()]
+            histogram.max = maxima[i].item()
+            cluster_percentiles[label] = histogram.percentiles()
+        return cluster_percentiles
+
+    def find_stragglers(self, labels, threshold=1.2):
+        """
+        Compare the median duration of `labels` across workers, over the events since the
+        previous call. Returns {label: stats} where the stats contain the median over
+        workers, the slowest worker and how much slower it is, and all workers that are more
+        than `threshold` times slower than the median worker.
+        This is a collective operation that all workers need to call.
+        """
+        import torch.distributed as dist
+
+        medians = torch.full([len(labels)], float("nan"), dtype=torch.float64)
+        with self._flush_lock:
+            self.flush()
+            for i, label in enumerate(labels):
+                if label not in self.histograms:
+                    continue
+                histogram = self.histograms[label]
+                recent = LogHistogram()
+                recent.counts = list(histogram.counts)
+                for index, count in enumerate(self._histograms_at_last_exchange.get(label, [])):
+                    recent.counts[index] -= count
+                recent.max = histogram.max
+                medians[i] = recent.quantile(0.5)
+                self._histograms_at_last_exchange[label] = list(histogram.counts)
+
+        device = torch.device("cuda") if dist.get_backend() == "nccl" else torch.device("cpu")
+        medians = medians.to(device)
+        medians_per_worker = [torch.empty_like(medians) for _ in range(dist.get_world_size())]
+        dist.all_gather(medians_per_worker, medians)
+        medians_per_worker = torch.stack(medians_per_worker).cpu()
+
+        stragglers = {}
+        for i, label in enumerate(labels):
+            durations = medians_per_worker[:, i]
+            if torch.isnan(durations).any():
+                continue  # not every worker has seen this label
+            median = durations.median().item()
+            slowest_rank = durations.argmax().item()
+            stragglers[label] = {
+                "median": median,
+                "slowest_rank": slowest_rank,
+                "slowdown": durations[slowest_rank].item() / median,
+                "stragglers": [
+                    rank
+                    for rank, duration in enumerate(durations.tolist())
+                    if duration > threshold * median
+                ],
+            }
+        return stragglers
+
+    def save_trace(self, json_file_path):
+        """Write the recorded spans in the Chrome trace event format"""
+        with self._flush_lock:
+            self.flush()
+            spans = list(self.spans)
+        thread_ids = {}  # small numbers are easier to read in the viewer
+        process_name = {"name": f"rank {self.rank}"}
+        events = [{"name": "process_name", "ph": "M", "pid": self.rank, "args": process_name}]
+        for label, start, end, thread_id in spans:
+            events.append(
+                {
+                    "name": label,
+                    "cat": label.split(".")[0],
+                    "ph": "X",
+                    "ts": (start + self._wall_clock_offset_ns) / 1000,
+                    "dur": (end - start) / 1000,
+                    "pid": self.rank,
+                    "tid": thread_ids.setdefault(thread_id, len(thread_ids)),
+                }
+            )
+
+        with open(json_file_path, "w") as fp:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+
+    def _label_id(self, label):
+        label_id = self._label_ids.get(label)
+        if label_id is None:
+            with self._record_lock:
+                label_id = self._label_ids.get(label)
+                if label_id is None:
+                    label_id = len(self._labels)
+                    self._labels.append(label)
+                    self._label_ids[label] = label_id
+        return label_id
+
+    def _record(self, label_id, start, end, epoch):
+        event = (label_id, start, end, epoch, threading.get_ident())
+        with self._record_lock:
+            self._events[self._num_written % self.buffer_size] = event
+            self._num_written += 1
+
+    def _flush_periodically(self):
+        while not self._stop_flushing.wait(self.flush_interval):
+            self.flush()
+
     def _cuda_sync(self):
         """Finish all asynchronous GPU computations to get correct timings"""
-        if torch.cuda.is_available():
+        if self.cuda_sync:
             torch.cuda.synchronize()
 
     def _default_log_fn(self, _, values, tags):
@@ -130,3 +383,107 @@ class Timer:
         epoch = values["epoch"]
         duration = values["value"]
         print(f"Timer: {label:30s} @ {epoch:4.1f} - {duration:8.5f}s")
+
+
+def timed_iterator(iterable, timer, label, epoch=-1.0, verbosity=1):
+    """Iterate over `iterable`, timing how long it takes to produce each item"""
+    iterator = iter(iterable)
+    while True:
+        with timer(label, epoch, verbosity):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class LogHistogram:
+    """
+    Counts durations in logarithmically spaced buckets.
+    Percentiles have a relative error of at most ~2.5%, with constant memory.
+    """
+
+    MIN_VALUE = 1e-7  # [s], everything shorter falls in the first bucket
+    GROWTH = 1.05  # ratio between bucket boundaries
+    NUM_BUCKETS = 512  # up to ~6700s
+
+    def __init__(self):
+        self.counts = [0] * self.NUM_BUCKETS
+        self.max = 0.0
+
+    def add(self, value):
+        if value <= self.MIN_VALUE:
+            index = 0
+        else:
+            index = int(math.log(value / self.MIN_VALUE) / math.log(self.GROWTH)) + 1
+            index = min(index, self.NUM_BUCKETS - 1)
+        self.counts[index] += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        total = sum(self.counts)
+        if total == 0:
+            return float("nan")
+        threshold = q * total
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold and count > 0:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def percentiles(self):
+        return {
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+    def _bucket_value(self, index):
+        """Geometric center of a bucket"""
+        if index == 0:
+            return self.MIN_VALUE
+        return self.MIN_VALUE * self.GROWTH ** (index - 0.5)
+
+
+def merge_traces(json_file_paths, output_path):
+    """Combine the traces of several workers (see Timer.save_trace) into one file"""
+    events = []
+    for path in json_file_paths:
+        with open(path, "r") as fp:
+            events.extend(json.load(fp)["traceEvents"])
+
+    with open(output_path, "w") as fp:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+
+
+class _BufferedRegion:
+    """Context manager for one event in the low-overhead mode of Timer"""
+
+    __slots__ = ("timer", "label_id", "epoch", "start")
+
+    def __init__(self, timer, label_id, epoch):
+        self.timer = timer
+        self.label_id = label_id
+        self.epoch = epoch
+
+    def __enter__(self):
+        self.timer._cuda_sync()
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc_info):
+        self.timer._cuda_sync()
+        end = time.perf_counter_ns()
+        self.timer._record(self.label_id, self.start, end, self.epoch)
+
+
+class _NullRegion:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_REGION = _NullRegion()
@@ -3,19 +3,32 @@
 """
 This is used to measure the performance of collective communication operations
 in pytorch
+
+Every collective is timed for every dtype and message size, after a few warmup
+repetitions. A repetition takes as long as its slowest worker. Rank 0 writes one row per
+measurement to timings.csv and timings.json in the output directory. The JSON file
+also has an alpha-beta fit (time = latency + bytes / bandwidth) per collective and dtype.
+Fits whose time does not grow with the message size are marked `valid: false`, with null
+bandwidths.
+
+`message_sizes` is what each worker contributes, in bytes. reduce_scatter and all_to_all
+split it into `n_workers` chunks, so their sizes are rounded down to a multiple of that.
+The overlap test runs an asynchronous all-reduce together with matrix multiplications,
+to see how much communication can hide behind computation.
 """
 
+import csv
 import datetime
+import json
 import os
+import time
 
 import numpy as np
 import torch
 
-from timer import Timer
-
 config = dict(
-    distributed_backend="nccl",
-    device="cuda",
+    distributed_backend="gloo",
+    device="cpu",
     rank=1,
     n_workers=2,
     distributed_init_file=None,
@@ -35,16 +48,32 @@ config = dict(
         67_108_864,
         268_435_456,
     ],  # in bytes
-    repetitions=4,
+    collectives=["all_reduce", "all_gather", "reduce_scatter", "all_to_all", "gather", "broadcast"],
+    dtypes=["float32", "bfloat16", "int8"],
+    warmup_repetitions=2,
+    repetitions=20,
+    percentiles=[50, 90, 99],
+    overlap_message_sizes=[1_048_576, 16_777_216],  # in bytes, float32
+    overlap_matmul_size=512,  # square matrices multiplied while the all-reduce runs
+    overlap_num_matmuls=10,
 )
 
 output_dir = "./output.tmp"  # will be overwritten by run.py
 
+# Bytes a worker sends for every byte of its message, with ring algorithms
+# (the "bus bandwidth" convention of nccl-tests)
+BUS_BANDWIDTH_FACTORS = {
+    "all_reduce": lambda n: 2 * (n - 1) / n,
+    "all_gather": lambda n: n - 1,
+    "reduce_scatter": lambda n: (n - 1) / n,
+    "all_to_all": lambda n: (n - 1) / n,
+    "gather": lambda n: 1,
+    "broadcast": lambda n: 1,
+}
 
-def main():
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    timer = Timer(verbosity_level=2, log_fn=metric)
+def main():
+    device = torch.device(config["device"])
 
     if torch.distributed.is_available():
         if config["distributed_init_file"] is None:
@@ -62,57 +91,268 @@ def main():
             rank=config["rank"],
         )
 
-    # All reduce
-    for message_size in config["message_sizes"]:
-        # Create data
-        data = torch.randn(message_size // 4, device=config["device"])
-        for repetition in range(config["repetitions"]):
-            # Wait until everyone is ready
-            torch.distributed.barrier()
-            with timer(f"all_reduce_{message_size}"):
-                torch.distributed.all_reduce(data)
-
-    # All gather
-    all_gather_device = "cuda" if config["distributed_backend"] == "nccl" else "cpu"
-    for message_size in config["message_sizes"]:
-        # Create data
-        data = torch.randn(message_size // 4, device=all_gather_device)
-        other_data = [torch.empty_like(data) for i in range(config["n_workers"])]
-        for repetition in range(config["repetitions"]):
-            # Wait until everyone is ready
-            torch.distributed.barrier()
-            with timer(f"all_gather_{message_size}"):
-                torch.distributed.all_gather(other_data, data)
-
-    # Gather
-    gather_device = "cuda" if config["distributed_backend"] == "nccl" else "cpu"
-    if config["distributed_backend"] != "nccl":
-        for message_size in config["message_sizes"]:
-            # Create data
-            data = torch.randn(message_size // 4, device=gather_device)
-            if config["rank"] == 0:
-                other_data = [torch.empty_like(data) for i in range(config["n_workers"])]
-            else:
-                other_data = []
-            for repetition in range(config["repetitions"]):
-                # Wait until everyone is ready
-                torch.distributed.barrier()
-                with timer(f"gather_{message_size}"):
-                    torch.distributed.gather(data, other_data, dst=0)
-
-    # Broadcast
-    for message_size in config["message_sizes"]:
-        # Create data
-        data = torch.randn(message_size // 4, device=config["device"])
-        for repetition in range(config["repetitions"]):
-            # Wait until everyone is ready
-            torch.distributed.barrier()
-            with timer(f"broadcast_{message_size}"):
-                torch.distributed.broadcast(data, src=0)
-
-    print(timer.summary())
+    rows = []
+    for collective in config["collectives"]:
+        for dtype_name in config["dtypes"]:
+            dtype = getattr(torch, dtype_name)
+            for message_size in config["message_sizes"]:
+                # Workers agree on failures before they communicate, and after measuring.
+                # A collective that fails on only some workers once it communicates would
+                # leave the others waiting, which cannot be recovered from.
+                run, error = None, None
+                try:
+                    run = build_collective(collective, message_size, dtype, device)
+                except (RuntimeError, ValueError) as e:
+                    error = e
+                if skip_on_any_worker(error, collective, dtype_name, device):
+                    break
+                if run is None:
+                    continue  # the message is too small to split over the workers
+                try:
+                    durations = measure(run, device)
+                except (RuntimeError, ValueError) as e:
+                    error = e  # e.g. an operation or dtype the backend lacks
+                if skip_on_any_worker(error, collective, dtype_name, device):
+                    break
+                rows.append(summarize(collective, dtype_name, run.message_size, durations))
+
+    rows.extend(measure_overlap(device))
+
+    for row in rows:
+        metric(
+            "collective_time",
+            {key: value for key, value in row.items() if isinstance(value, (int, float))},
+            tags={"collective": row["collective"], "dtype": row["dtype"]},
+        )
+
+    fits = alpha_beta_fits(rows)
+    for fit in fits:
+        if not fit["valid"]:
+            continue
+        metric(
+            "collective_fit",
+            {
+                "latency": fit["latency"],
+                "bandwidth": fit["bandwidth"],
+                "bus_bandwidth": fit["bus_bandwidth"],
+            },
+            tags={"collective": fit["collective"], "dtype": fit["dtype"]},
+        )
+
     if config["rank"] == 0:
-        timer.save_summary(os.path.join(output_dir, "timer_summary.json"))
+        save_rows(rows, os.path.join(output_dir, "timings.csv"))
+        with open(os.path.join(output_dir, "timings.json"), "w") as fp:
+            json.dump({"config": config, "timings": rows, "fits": fits}, fp, indent=1)
+
+
+class Collective:
+    """A collective operation on preallocated tensors"""
+
+    def __init__(self, message_size, fn):
+        self.message_size = message_size  # in bytes, as actually sent by each worker
+        self.fn = fn
+
+    def __call__(self, async_op=False):
+        return self.fn(async_op=async_op)
+
+
+def build_collective(collective, message_size, dtype, device):
+    n_workers = config["n_workers"]
+    element_size = torch.empty([], dtype=dtype).element_size()
+    num_elements = message_size // element_size
+    if collective in ["reduce_scatter", "all_to_all"]:
+        num_elements -= num_elements % n_workers
+    if num_elements == 0:
+        return None
+    data = random_tensor(num_elements, dtype, device)
+    dist = torch.distributed
+
+    if collective == "all_reduce":
+        fn = lambda async_op: dist.all_reduce(data, async_op=async_op)
+    elif collective == "all_gather":
+        out = [torch.empty_like(data) for _ in range(n_workers)]
+        fn = lambda async_op: dist.all_gather(out, data, async_op=async_op)
+    elif collective == "reduce_scatter":
+        chunks = list(data.chunk(n_workers))
+        out = torch.empty_like(chunks[0])
+        fn = lambda async_op: dist.reduce_scatter(out, chunks, async_op=async_op)
+    elif collective == "all_to_all":
+        chunks = list(data.chunk(n_workers))
+        out = [torch.empty_like(chunk) for chunk in chunks]
+        fn = lambda async_op: dist.all_to_all(out, chunks, async_op=async_op)
+    elif collective == "gather":
+        out = [torch.empty_like(data) for _ in range(n_workers)] if config["rank"] == 0 else None
+        fn = lambda async_op: dist.gather(data, out, dst=0, async_op=async_op)
+    elif collective == "broadcast":
+        fn = lambda async_op: dist.broadcast(data, src=0, async_op=async_op)
+    else:
+        raise ValueError(f"Unknown collective {collective}")
+
+    return Collective(num_elements * element_size, fn)
+
+
+def random_tensor(num_elements, dtype, device):
+    if dtype.is_floating_point:
+        return torch.randn(num_elements, device=device).to(dtype)
+    else:
+        return torch.randint(-100, 100, [num_elements], device=device, dtype=dtype)
+
+
+def measure(fn, device):
+    """
+    Durations in seconds of `config["repetitions"]` runs of `fn`, after warmup.
+    Every duration is the maximum over the workers.
+    """
+    for _ in range(config["warmup_repetitions"]):
+        fn()
+    synchronize(device)
+
+    durations = torch.empty(config["repetitions"], dtype=torch.float64)
+    for repetition in range(config["repetitions"]):
+        # Wait until everyone is ready
+        torch.distributed.barrier()
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        durations[repetition] = time.perf_counter() - start
+
+    return max_over_workers(durations, device)
+
+
+def measure_overlap(device):
+    """
+    Time an async all-reduce, a series of matrix multiplications, and both at the same time.
+    `overlap` is the fraction of the shorter one that was hidden behind the longer one.
+    """
+    n = config["overlap_matmul_size"]
+    a = torch.randn(n, n, device=device)
+    b = torch.randn(n, n, device=device)
+
+    def compute(async_op=False):
+        for _ in range(config["overlap_num_matmuls"]):
+            torch.mm(a, b)
+
+    rows = []
+    for message_size in config["overlap_message_sizes"]:
+        communicate = build_collective("all_reduce", message_size, torch.float32, device)
+
+        def both(async_op=False):
+            handle = communicate(async_op=True)
+            compute()
+            handle.wait()
+
+        communication_time = np.median(measure(communicate, device))
+        compute_time = np.median(measure(compute, device))
+        durations = measure(both, device)
+        both_time = np.median(durations)
+        hidden = communication_time + compute_time - both_time
+        row = summarize("all_reduce+matmul", "float32", communicate.message_size, durations)
+        row["communication_time"] = communication_time
+        row["compute_time"] = compute_time
+        row["overlap"] = max(0.0, hidden / min(communication_time, compute_time))
+        rows.append(row)
+    return rows
+
+
+def summarize(collective, dtype, message_size, durations):
+    n_workers = config["n_workers"]
+    median = np.median(durations)
+    row = {
+        "collective": collective,
+        "dtype": dtype,
+        "backend": config["distributed_backend"],
+        "device": config["device"],
+        "n_workers": n_workers,
+        "message_size": message_size,
+        "repetitions": len(durations),
+        "mean": np.mean(durations),
+        "min": np.min(durations),
+        "max": np.max(durations),
+        **{f"p{q}": np.percentile(durations, q) for q in config["percentiles"]},
+    }
+    if collective in BUS_BANDWIDTH_FACTORS:
+        row["bandwidth"] = message_size / median
+        row["bus_bandwidth"] = row["bandwidth"] * BUS_BANDWIDTH_FACTORS[collective](n_workers)
+    return {key: to_builtin(value) for key, value in row.items()}
+
+
+def alpha_beta_fits(rows):
+    """
+    Fit time = latency + message_size / bandwidth to the median times of every collective
+    and dtype. The fit minimizes relative errors, so small messages determine the latency
+    as much as large messages determine the bandwidth.
+    With noisy or flat timings, the fitted time per byte can be zero or negative. Such fits
+    are not valid and have no bandwidth.
+    """
+    groups = {}
+    for row in rows:
+        if row["collective"] in BUS_BANDWIDTH_FACTORS:
+            groups.setdefault((row["collective"], row["dtype"]), []).append(row)
+
+    fits = []
+    for (collective, dtype), group in sorted(groups.items()):
+        if len(group) < 2:
+            continue
+        sizes = np.array([row["message_size"] for row in group], dtype=np.float64)
+        times = np.array([row["p50"] for row in group], dtype=np.float64)
+        seconds_per_byte, latency = np.polyfit(sizes, times, deg=1, w=1 / times)
+        valid = seconds_per_byte > 0
+        bandwidth = 1 / seconds_per_byte if valid else None
+        factor = BUS_BANDWIDTH_FACTORS[collective](config["n_workers"])
+        fits.append(
+            {
+                "collective": collective,
+                "dtype": dtype,
+                "valid": bool(valid),
+                "latency": float(latency),
+                "bandwidth": float(bandwidth) if valid else None,
+                "bus_bandwidth": float(bandwidth * factor) if valid else None,
+                "max_relative_error": float(
+                    np.max(np.abs(latency + sizes * seconds_per_byte - times) / times)
+                ),
+            }
+        )
+    return fits
+
+
+def save_rows(rows, csv_file_path):
+    fieldnames = []
+    for row in rows:
+        fieldnames.extend(key for key in row if key not in fieldnames)
+    with open(csv_file_path, "w", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def skip_on_any_worker(error, collective, dtype_name, device):
+    """Whether any worker has an `error`, so all workers skip the rest of this dtype"""
+    failed = error is not None
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        flag = torch.tensor([float(failed)], device=device)
+        torch.distributed.all_reduce(flag, op=torch.distributed.ReduceOp.MAX)
+        failed = flag.item() > 0
+    if failed and config["rank"] == 0:
+        reason = error if error is not None else "failed on another worker"
+        print(f"Skipping {collective} with {dtype_name}: {reason}")
+    return failed
+
+
+def max_over_workers(durations, device):
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        durations = durations.to(device)
+        torch.distributed.all_reduce(durations, op=torch.distributed.ReduceOp.MAX)
+    return durations.cpu().numpy()
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def to_builtin(value):
+    """numpy scalars as python numbers, for JSON"""
+    return value.item() if isinstance(value, np.generic) else value
 
 
 def log_info(info_dict):
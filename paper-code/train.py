@@ -5,13 +5,18 @@ import os
 import re
 import time
 
+# Before the heavy imports below, for the time-to-first-batch metric
+STARTUP_TIME = time.perf_counter()
+
+
 import numpy as np
 import torch
 
 import gradient_reducers
 import tasks
-from mean_accumulator import MeanAccumulator
-from timer import Timer
+from checkpoint import AsyncCheckpointer, load_training_state, save_training_state
+from mean_accumulator import DeferredMetrics, MetricsAccumulator, ModelAverage
+from timer import Timer, timed_iterator
 
 """
 When you run this script, it uses the default parameters below.
@@ -30,12 +35,15 @@ The configuration overrides we used for all our experiments can be found in the
 
 config = dict(
     average_reset_epoch_interval=30,
+    average_ema_decay=None,  # None: arithmetic mean of the model since the last reset
+    test_runavg_in_background=False,  # evaluate the average model while training continues (Cifar)
     # distributed_backend="nccl",
     distributed_backend="gloo",
     
     fix_conv_weight_norm=False,
     num_epochs=10,#CHANGE LATER
     checkpoints=[],
+    resume_from=None,  # a checkpoint directory (like output_dir/epoch_004) to continue training from
     num_train_tracking_batches=1,
     optimizer_batch_size=128,  # per worker
     optimizer_conv_learning_rate=0.1,  # tuned for batch size 128
@@ -43,6 +51,10 @@ config = dict(
     optimizer_decay_with_factor=10.0,
     optimizer_learning_rate=0.1,  # Tuned for batch size 128 (single worker)
     optimizer_memory=True,
+    # "bfloat16", "float16" or "int8" to store the memory compactly between steps. During a step
+    # it is expanded into one float32 buffer that the reducer sends from, as if in place
+    optimizer_memory_dtype=None,
+    optimizer_memory_in_place=False,  # accumulate gradients into the memory, without send buffers
     optimizer_momentum_type="nesterov",
     optimizer_momentum=0.9,
     optimizer_reducer="ExactReducer",
@@ -59,11 +71,19 @@ config = dict(
     optimizer_weight_decay_bn=0.0,
     task="Cifar",
     task_architecture="ResNet18",
+    task_cifar_dataset="torchvision",  # "mmap": memory-mapped uint8 data, batched augmentation
+    task_num_prefetch_batches=2,  # prepared in a background thread, 0 to disable
     seed=42,
     rank=0,
     n_workers=5,
     distributed_init_file="/home/adithyakanil/Desktop/powersgd/shared/ddp_init",
     log_verbosity=2,
+    log_timer_cuda_sync=True,  # False: don't wait for the GPU around every timed region
+    log_timer_buffer_size=0,  # > 0: record events in a ring buffer that is flushed asynchronously
+    log_timer_trace=False,  # write a Chrome trace of all timed regions per worker
+    log_straggler_phases=["batch.load", "batch.forward", "batch.backward", "batch.reduce"],
+    log_straggler_threshold=1.2,  # report workers this much slower than the median worker
+    log_communication_per_layer=False,  # also log how many bytes every layer communicated
 )
 
 output_dir = "./output.tmp"  # will be overwritten by run.py
@@ -76,7 +96,14 @@ def main():
     # device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     device = torch.device("cpu")
 
-    timer = Timer(verbosity_level=config["log_verbosity"], log_fn=metric)
+    timer = Timer(
+        verbosity_level=config["log_verbosity"],
+        log_fn=metric,
+        cuda_sync=config["log_timer_cuda_sync"],
+        buffer_size=config["log_timer_buffer_size"],
+        trace=config["log_timer_trace"],
+        rank=config["rank"],
+    )
 
     if torch.distributed.is_available():
         if config["distributed_init_file"] is None:
@@ -100,20 +127,68 @@ def main():
         elif config["task"] == "LSTM":
             download_wikitext2()
     torch.distributed.barrier()
-    torch.cuda.synchronize()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
 
 
     task = tasks.build(task_name=config["task"], device=device, timer=timer, **config)
     reducer = get_reducer(device, timer)
+    checkpointer = AsyncCheckpointer(config["rank"], config["n_workers"], timer)
 
     bits_communicated = 0
-    runavg_model = MeanAccumulator()
+    runavg_model = ModelAverage(ema_decay=config["average_ema_decay"])
 
-    memories = [torch.zeros_like(param) for param in task.state]
+    memory_buffer = None
+    if config["optimizer_memory"] and config["optimizer_memory_dtype"] is not None:
+        # Between steps, the error feedback is only kept in low precision
+        from powersgd.error_feedback import ErrorFeedbackBuffer
+
+        memory_buffer = ErrorFeedbackBuffer(
+            task.state, config["optimizer_memory_dtype"], seed=config["seed"] + config["rank"]
+        )
     momenta = [torch.empty_like(param) for param in task.state]  # need initialization
-    send_buffers = [torch.zeros_like(param) for param in task.state]
-    for epoch in range(config["num_epochs"]):
-        epoch_metrics = MeanAccumulator()
+
+    # With an in-place memory, the reducer reads the gradient from the memory and overwrites it
+    # with the compression error, so no separate send buffers are needed.
+    # A low-precision memory is expanded into `memories` every step, so it is always in place.
+    memory_in_place = config["optimizer_memory"] and (
+        config["optimizer_memory_in_place"] or memory_buffer is not None
+    )
+    memories = [torch.zeros_like(param) for param in task.state]
+    if not memory_in_place:
+        send_buffers = [torch.zeros_like(param) for param in task.state]
+
+    def log_runavg_test(epoch, bits_communicated, test_stats):
+        if not isinstance(test_stats, dict):
+            test_stats = test_stats.result()  # from test_in_background
+        for key, value in test_stats.items():
+            metric(
+                f"runavg_{key}",
+                {"value": value.item(), "epoch": epoch + 1.0, "bits": bits_communicated},
+                tags={"split": "test"},
+            )
+
+    start_epoch = 0
+    if config["resume_from"] is not None:
+        resumed = load_training_state(
+            config["resume_from"],
+            config["rank"],
+            task,
+            reducer,
+            momenta,
+            memories,
+            memory_buffer,
+            runavg_model,
+        )
+        start_epoch = int(resumed["epoch"])
+        bits_communicated = resumed["bits_communicated"]
+        info({"state.resumed_from_epoch": start_epoch})
+
+    pending_runavg_test = None
+    for epoch in range(start_epoch, config["num_epochs"]):
+        epoch_metrics = MetricsAccumulator()
+        # Sampled per-batch metrics are logged at the end of the epoch, to not wait for the device
+        batch_metric = DeferredMetrics(metric)
         info({"state.progress": float(epoch) / config["num_epochs"], "state.current_epoch": epoch})
 
         # This seems fine ...
@@ -127,7 +202,7 @@ def main():
             runavg_model.reset()
 
         train_loader = task.train_iterator(config["optimizer_batch_size"])
-        for i, batch in enumerate(train_loader):
+        for i, batch in enumerate(timed_iterator(train_loader, timer, "batch.load", epoch)):
             epoch_frac = epoch + i / len(train_loader)
             lrs = [get_learning_rate(epoch_frac, name) for name in task.parameter_names]
 
@@ -140,17 +215,17 @@ def main():
                     for name, param, grad, lr in zip(task.parameter_names, task.state, grads, lrs):
                         if np.random.rand() < 0.001:  # with a small probability
                             tags = {"weight": name.replace("module.", "")}
-                            metric(
+                            batch_metric(
                                 "effective_lr",
                                 {
                                     "epoch": epoch_frac,
-                                    "value": lr / max(l2norm(param).item() ** 2, 1e-8),
+                                    "value": lr / torch.clamp(l2norm(param) ** 2, min=1e-8),
                                 },
                                 tags,
                             )
-                            metric(
+                            batch_metric(
                                 "grad_norm",
-                                {"epoch": epoch_frac, "value": l2norm(grad).item()},
+                                {"epoch": epoch_frac, "value": l2norm(grad)},
                                 tags,
                             )
 
@@ -178,17 +253,30 @@ def main():
                             replace_grad_by_momentum(grad, momentum)
 
                 with timer("batch.accumulate", epoch_frac, verbosity=2):
-                    for grad, memory, send_bfr in zip(grads, memories, send_buffers):
-                        if config["optimizer_memory"]:
-                            send_bfr.data[:] = grad + memory
-                        else:
-                            send_bfr.data[:] = grad
+                    if memory_buffer is not None:
+                        # Overwrites the previous step's float32 residual
+                        memory_buffer.add_to(grads, out=memories)
+                    elif memory_in_place:
+                        for grad, memory in zip(grads, memories):
+                            memory.add_(grad)
+                    else:
+                        for grad, memory, send_bfr in zip(grads, memories, send_buffers):
+                            if config["optimizer_memory"]:
+                                torch.add(grad, memory, out=send_bfr)
+                            else:
+                                send_bfr.data[:] = grad
 
                 with timer("batch.reduce", epoch_frac):
                     # Set 'grads' to the averaged value from the workers
-                    bits_communicated += reducer.reduce(send_buffers, grads, memories)
+                    bits_communicated += reducer.reduce(
+                        memories if memory_in_place else send_buffers, grads, memories
+                    )
 
-                if config["optimizer_memory"]:
+                if memory_buffer is not None:
+                    with timer("batch.store_memory", epoch_frac, verbosity=2):
+                        memory_buffer.store(memories)
+
+                if config["optimizer_memory"] and not memory_in_place:
                     with timer("batch.reporting.compr_err", verbosity=2):
                         for name, memory, send_bfr in zip(
                             task.parameter_names, memories, send_buffers
@@ -196,9 +284,9 @@ def main():
                             if np.random.rand() < 0.001:
                                 tags = {"weight": name.replace("module.", "")}
                                 rel_compression_error = l2norm(memory) / l2norm(send_bfr)
-                                metric(
+                                batch_metric(
                                     "rel_compression_error",
-                                    {"epoch": epoch_frac, "value": rel_compression_error.item()},
+                                    {"epoch": epoch_frac, "value": rel_compression_error},
                                     tags,
                                 )
 
@@ -246,17 +334,23 @@ def main():
                                 tags = {"weight": parameter_name.replace("module.", "")}
                                 sq_norm = torch.sum(memory ** 2)
                                 sum_of_sq += torch.sqrt(sq_norm)
-                                metric(
+                                batch_metric(
                                     "memory_norm",
-                                    {"epoch": epoch_frac, "value": torch.sqrt(sq_norm).item()},
+                                    {"epoch": epoch_frac, "value": torch.sqrt(sq_norm)},
                                     tags,
                                 )
-                            metric(
+                            batch_metric(
                                 "compression_error",
-                                {"epoch": epoch_frac, "value": torch.sqrt(sum_of_sq).item()},
+                                {"epoch": epoch_frac, "value": torch.sqrt(sum_of_sq)},
                             )
 
+            if epoch == start_epoch and i == 0:
+                time_to_first_batch = time.perf_counter() - STARTUP_TIME
+                info({"state.time_to_first_batch": time_to_first_batch})
+                metric("time_to_first_batch", {"value": time_to_first_batch, "epoch": 0.0})
+
         with timer("epoch_metrics.collect", epoch + 1.0, verbosity=2):
+            batch_metric.flush()
             epoch_metrics.reduce()
             for key, value in epoch_metrics.value().items():
                 metric(
@@ -270,6 +364,30 @@ def main():
                     tags={"split": "train"},
                 )
 
+        with timer("stragglers", epoch + 1.0, verbosity=2):
+            stragglers = timer.find_stragglers(
+                config["log_straggler_phases"], config["log_straggler_threshold"]
+            )
+            if config["rank"] == 0:
+                for phase, stats in stragglers.items():
+                    metric(
+                        "straggler_slowdown",
+                        {
+                            "value": stats["slowdown"],
+                            "epoch": epoch + 1.0,
+                            "rank": stats["slowest_rank"],
+                        },
+                        tags={"phase": phase},
+                    )
+                    for straggler in stats["stragglers"]:
+                        print(
+                            f"Straggler in {phase}: rank {straggler} is more than "
+                            f"{config['log_straggler_threshold']}x slower than the median worker"
+                        )
+
+        with timer("communication_metrics", epoch + 1.0, verbosity=2):
+            log_communication(reducer.communication, epoch, task.parameter_names, metric)
+
         with timer("test.last", epoch):
             test_stats = task.test()
             for key, value in test_stats.items():
@@ -280,40 +398,85 @@ def main():
                 )
 
         with timer("test.runavg", epoch):
-            test_stats = task.test(state_dict=runavg_model.value())
-            for key, value in test_stats.items():
-                metric(
-                    f"runavg_{key}",
-                    {"value": value.item(), "epoch": epoch + 1.0, "bits": bits_communicated},
-                    tags={"split": "test"},
+            if config["test_runavg_in_background"]:
+                # Log the evaluation started in the previous epoch, and start a new one
+                if pending_runavg_test is not None:
+                    log_runavg_test(*pending_runavg_test)
+                pending_runavg_test = (
+                    epoch,
+                    bits_communicated,
+                    task.test_in_background(state_dict=runavg_model.value()),
                 )
+            else:
+                test_stats = task.test(state_dict=runavg_model.value())
+                log_runavg_test(epoch, bits_communicated, test_stats)
 
-        if epoch in config["checkpoints"] and torch.distributed.get_rank() == 0:
+        if epoch in config["checkpoints"]:
             with timer("checkpointing"):
+                # Written in the background, every worker writes a part
                 save(
+                    checkpointer,
                     os.path.join(output_dir, "epoch_{:03d}".format(epoch)),
-                    task.state_dict(),
+                    task,
+                    reducer,
+                    momenta,
+                    memories,
+                    memory_buffer,
+                    runavg_model,
                     epoch + 1.0,
+                    bits_communicated,
                     test_stats,
                 )
-                # Save running average model @TODO
 
         print(timer.summary())
+        cluster_percentiles = timer.cluster_percentiles()
         if config["rank"] == 0:
-            timer.save_summary(os.path.join(output_dir, "timer_summary.json"))
+            timer.save_summary(
+                os.path.join(output_dir, "timer_summary.json"), cluster_percentiles
+            )
 
-    info({"state.progress": 1.0})
+    if pending_runavg_test is not None:
+        log_runavg_test(*pending_runavg_test)
 
+    checkpointer.close()
+    timer.close()
+    if config["log_timer_trace"]:
+        timer.save_trace(
+            os.path.join(output_dir, "timer_trace.rank{:03d}.json".format(config["rank"]))
+        )
+    info({"state.progress": 1.0})
 
-def save(destination_path, model_state, epoch, test_stats):
-    """Save a checkpoint to disk"""
-    # Workaround for RuntimeError('Unknown Error -1')
-    # https://github.com/pytorch/pytorch/issues/10577
-    time.sleep(1)
 
-    torch.save(
-        {"epoch": epoch, "test_stats": test_stats, "model_state_dict": model_state},
+def save(
+    checkpointer,
+    destination_path,
+    task,
+    reducer,
+    momenta,
+    memories,
+    memory_buffer,
+    runavg_model,
+    epoch,
+    bits_communicated,
+    test_stats,
+):
+    """Start saving the training state to the directory `destination_path`, see checkpoint.py"""
+    save_training_state(
+        checkpointer,
         destination_path,
+        task,
+        reducer,
+        momenta,
+        memories,
+        memory_buffer,
+        runavg_model,
+        # Momenta of averaged gradients are the same on all workers
+        momenta_are_shared=not config["optimizer_mom_before_reduce"],
+        metadata={
+            "epoch": epoch,
+            "bits_communicated": bits_communicated,
+            "test_stats": test_stats,
+        },
     )
 
 
@@ -384,63 +547,29 @@ def replace_grad_by_momentum(grad, momentum):
 
 def get_reducer(device, timer):
     """Configure the reducer from the config"""
-    if config["optimizer_reducer"] in ["RankKReducer"]:
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            n_power_iterations=config["optimizer_reducer_n_power_iterations"],
-            reuse_query=config["optimizer_reducer_reuse_query"],
-            rank=config["optimizer_reducer_rank"],
-        )
-    elif config["optimizer_reducer"] == "AtomoReducer":
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            rank=config["optimizer_reducer_rank"],
-        )
-    elif config["optimizer_reducer"] == "RandomSparseReducer":
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            rank=config["optimizer_reducer_rank"],
-        )
-    elif config["optimizer_reducer"] == "RandomSparseBlockReducer":
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            rank=config["optimizer_reducer_rank"],
-        )
-    elif (
-        config["optimizer_reducer"] == "GlobalTopKReducer"
-        or config["optimizer_reducer"] == "TopKReducer"
-        or config["optimizer_reducer"] == "UniformRandomSparseBlockReducer"
-        or config["optimizer_reducer"] == "UniformRandomSparseReducer"
-    ):
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            compression=config["optimizer_reducer_compression"],
-        )
-    elif config["optimizer_reducer"] == "HalfRankKReducer":
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            rank=config["optimizer_reducer_rank"],
-        )
-    elif config["optimizer_reducer"] == "SVDReducer":
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            config["seed"], device, timer, config["optimizer_reducer_rank"]
-        )
-    else:
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            config["seed"], device, timer
+    return gradient_reducers.build_reducer(config["optimizer_reducer"], config, device, timer)
+
+
+
+def log_communication(communication, epoch, parameter_names, log_fn):
+    """Log what the reducer communicated since the last call, and start counting again"""
+    if communication is None:
+        return  # the powersgd package of this repository is not installed
+    for entry in communication.summary():
+        values = {key: value for key, value in entry.items() if key not in ["collective", "phase"]}
+        log_fn(
+            "communication",
+            {**values, "epoch": epoch + 1.0},
+            tags={"collective": entry["collective"], "phase": entry["phase"]},
         )
+    if config["log_communication_per_layer"]:
+        for (phase, layer), num_bytes in sorted(communication.layer_bytes.items()):
+            log_fn(
+                "communication_per_layer",
+                {"bytes": num_bytes, "epoch": epoch + 1.0},
+                tags={"phase": phase, "layer": parameter_names[layer]},
+            )
+    communication.reset()
 
 
 @torch.jit.script
@@ -15,6 +15,12 @@ import tasks
 from mean_accumulator import MeanAccumulator
 from timer import Timer
 
+try:
+    # Communication is only logged per collective with the powersgd package of this repository
+    from powersgd.communication import CommunicationLog
+except ImportError:
+    CommunicationLog = None
+
 """
 When you run this script, it uses the default parameters below.
 To change them, you can make another script, say `experiment.py`
@@ -166,24 +172,33 @@ def main():
 
         task._model.register_comm_hook(process_group, hook)
 
-    communication = {"bits": 0}
+    communication = CommunicationLog() if CommunicationLog is not None else None
+    bits_communicated = 0
 
-    # Override dist.all_reduce so we can keep track of the amount communicated
+    # Override dist.all_reduce so we can keep track of the amount communicated,
+    # also by the all-reduces that the communication hooks start themselves
     all_reduce_orig = dist.all_reduce
 
-    def all_reduce_with_logging(*args, **kwargs):
-        tensor = args[0]
+    def all_reduce_with_logging(tensor, *args, **kwargs):
+        nonlocal bits_communicated
+        num_bytes = tensor.nelement() * tensor.element_size()
+        bits_communicated += 8 * num_bytes
         start = time.time_ns() / 1_000_000_000
 
-        def stop_the_time(fut):
-            torch.cuda.synchronize()
+        def stop_the_time(fut=None):
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
             end = time.time_ns() / 1_000_000_000
             timer.report("all_reduce", start, end)
-            return fut.value()
+            if communication is not None:
+                communication.record("all_reduce", "all_reduce", num_bytes, end - start)
+            return fut.value() if fut is not None else None
 
-        communication["bits"] += 8 * tensor.nelement() * tensor.element_size()
-        ret = all_reduce_orig(*args, **kwargs)
-        ret.get_future().then(stop_the_time)
+        ret = all_reduce_orig(tensor, *args, **kwargs)
+        if ret is None:  # a synchronous all-reduce, like the ones of MeanAccumulator
+            stop_the_time()
+        else:
+            ret.get_future().then(stop_the_time)
         return ret
 
     dist.all_reduce = all_reduce_with_logging
@@ -227,6 +242,10 @@ def main():
 
         scheduler.step()
 
+        if communication is not None:
+            with timer("communication_metrics", epoch + 1.0, verbosity=2):
+                log_communication(communication, epoch)
+
         with timer("epoch_metrics.collect", epoch + 1.0, verbosity=2):
             epoch_metrics.reduce()
             for key, value in epoch_metrics.value().items():
@@ -235,7 +254,7 @@ def main():
                     {
                         "value": value.item(),
                         "epoch": epoch + 1.0,
-                        "bits": communication["bits"],
+                        "bits": bits_communicated,
                     },
                     tags={"split": "train"},
                 )
@@ -244,7 +263,7 @@ def main():
                     {
                         "value": value.item(),
                         "epoch": epoch + 1.0,
-                        "bits": communication["bits"],
+                        "bits": bits_communicated,
                     },
                     tags={"split": "train"},
                 )
@@ -257,7 +276,7 @@ def main():
                     {
                         "value": value.item(),
                         "epoch": epoch + 1.0,
-                        "bits": communication["bits"],
+                        "bits": bits_communicated,
                     },
                     tags={"split": "test"},
                 )
@@ -269,6 +288,18 @@ def main():
     info({"state.progress": 1.0})
 
 
+def log_communication(communication, epoch):
+    """Log what was communicated since the last call, and start counting again"""
+    for entry in communication.summary():
+        values = {key: value for key, value in entry.items() if key not in ["collective", "phase"]}
+        metric(
+            "communication",
+            {**values, "epoch": epoch + 1.0},
+            tags={"collective": entry["collective"], "phase": entry["phase"]},
+        )
+    communication.reset()
+
+
 def save(destination_path, model_state, epoch, test_stats):
     """Save a checkpoint to disk"""
     # Workaround for RuntimeError('Unknown Error -1')
@@ -364,67 +395,6 @@ def replace_grad_by_momentum(grad, momentum):
         raise ValueError("Unknown momentum type")
 
 
-def get_reducer(device, timer):
-    """Configure the reducer from the config"""
-    if config["optimizer_reducer"] in ["RankKReducer"]:
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            n_power_iterations=config["optimizer_reducer_n_power_iterations"],
-            reuse_query=config["optimizer_reducer_reuse_query"],
-            rank=config["optimizer_reducer_rank"],
-        )
-    elif config["optimizer_reducer"] == "AtomoReducer":
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            rank=config["optimizer_reducer_rank"],
-        )
-    elif config["optimizer_reducer"] == "RandomSparseReducer":
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            rank=config["optimizer_reducer_rank"],
-        )
-    elif config["optimizer_reducer"] == "RandomSparseBlockReducer":
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            rank=config["optimizer_reducer_rank"],
-        )
-    elif (
-        config["optimizer_reducer"] == "GlobalTopKReducer"
-        or config["optimizer_reducer"] == "TopKReducer"
-        or config["optimizer_reducer"] == "UniformRandomSparseBlockReducer"
-        or config["optimizer_reducer"] == "UniformRandomSparseReducer"
-    ):
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            compression=config["optimizer_reducer_compression"],
-        )
-    elif config["optimizer_reducer"] == "HalfRankKReducer":
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            random_seed=config["seed"],
-            device=device,
-            timer=timer,
-            rank=config["optimizer_reducer_rank"],
-        )
-    elif config["optimizer_reducer"] == "SVDReducer":
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            config["seed"], device, timer, config["optimizer_reducer_rank"]
-        )
-    else:
-        return getattr(gradient_reducers, config["optimizer_reducer"])(
-            config["seed"], device, timer
-        )
-
-
 @torch.jit.script
 def l2norm(tensor):
     """Compute the L2 Norm of a tensor in a fast and correct way"""
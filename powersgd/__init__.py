@@ -1,5 +1,7 @@
 import torch
 
+from powersgd.communication import CommunicationLog
+from powersgd.error_feedback import ErrorFeedbackBuffer
 from powersgd.powersgd import Aggregator, AllReduce, Config, PowerSGD
 from powersgd.utils import params_in_optimizer
 
@@ -12,6 +14,9 @@ def optimizer_step(optimizer: torch.optim.Optimizer, aggregator: Aggregator):
     params = params_in_optimizer(optimizer)
     grads = [p.grad.data for p in params]  # type: ignore
     avg_grads = aggregator.aggregate(grads)  # subtracts the approximation from grads
+    if aggregator.accumulating:
+        # The gradients keep accumulating in `p.grad` until the next communication round
+        return
 
     # Temporarily set parameter's gradients to the aggregated values
     for (p, g) in zip(params, avg_grads):
@@ -20,6 +25,8 @@ def optimizer_step(optimizer: torch.optim.Optimizer, aggregator: Aggregator):
     # Run an optimizer step
     optimizer.step()
 
-    # Put back the error buffer as the parameter's gradient
+    # Put back the error buffer as the parameter's gradient.
+    # If the aggregator keeps the errors itself,
+    # free the gradients until the next backward pass.
     for (p, g) in zip(params, grads):
-        p.grad = g
+        p.grad = None if aggregator.stores_error_feedback else g
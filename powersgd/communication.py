@@ -0,0 +1,181 @@
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+
+class CommunicationLog:
+    """
+    Counts what collectives communicate, per collective and phase, and per layer.
+
+    `bytes` is the size of the tensor a worker contributes. `bytes_sent` is what
+    one worker sends (and receives) with ring algorithms: 2 (n-1)/n times the size
+    for all-reduce, and n-1 times the size for all-gather, with n workers.
+    Times are wall-clock times from the start of a collective until it is done
+    (or waited for), so bandwidths are achieved bandwidths, including waiting for
+    other workers.
+    With `cuda_sync`, the device is synchronized around collectives on GPU tensors,
+    otherwise their times only cover launching them.
+    """
+
+    def __init__(self, cuda_sync: bool = False):
+        self.cuda_sync = cuda_sync
+        self.counters: Dict[Tuple[str, str], Dict[str, float]] = defaultdict(
+            lambda: {"calls": 0, "bytes": 0, "bytes_sent": 0, "seconds": 0.0}
+        )
+        # Keyed by (phase, layer)
+        self.layer_bytes: Dict[Tuple[str, Any], int] = defaultdict(int)
+
+    def record(
+        self,
+        collective: str,
+        phase: str,
+        num_bytes: int,
+        seconds: float = 0.0,
+        layers: Optional[Dict[Any, int]] = None,
+    ):
+        """`layers` optionally maps layers to how many of `num_bytes` belong to them"""
+        counters = self.counters[(collective, phase)]
+        counters["calls"] += 1
+        counters["bytes"] += num_bytes
+        counters["bytes_sent"] += _bytes_sent(collective, num_bytes)
+        counters["seconds"] += seconds
+        if layers is not None:
+            for layer, layer_bytes in layers.items():
+                self.layer_bytes[(phase, layer)] += layer_bytes
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(counters["bytes"] for counters in self.counters.values())
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """
+        One entry per collective and phase, with the counters and the achieved
+        bandwidth in bytes per second (`bandwidth` for the contributed bytes,
+        `bus_bandwidth` for the bytes sent).
+        """
+        entries = []
+        for (collective, phase), counters in sorted(self.counters.items()):
+            seconds = counters["seconds"]
+            entries.append(
+                {
+                    "collective": collective,
+                    "phase": phase,
+                    **counters,
+                    "bandwidth": counters["bytes"] / seconds if seconds > 0 else 0.0,
+                    "bus_bandwidth": (
+                        counters["bytes_sent"] / seconds if seconds > 0 else 0.0
+                    ),
+                }
+            )
+        return entries
+
+    def reset(self):
+        self.counters.clear()
+        self.layer_bytes.clear()
+
+    def _synchronize(self, tensor: torch.Tensor):
+        if self.cuda_sync and tensor.is_cuda:
+            torch.cuda.synchronize(tensor.device)
+
+
+def all_reduce(
+    tensor: torch.Tensor,
+    log: Optional[CommunicationLog] = None,
+    phase: str = "",
+    layers: Optional[Dict[Any, int]] = None,
+    async_op: bool = False,
+):
+    """torch.distributed.all_reduce, recorded in `log` if it is given"""
+    if log is None:
+        return torch.distributed.all_reduce(tensor, async_op=async_op)
+    num_bytes = tensor.nelement() * tensor.element_size()
+    return _logged(
+        log,
+        "all_reduce",
+        phase,
+        num_bytes,
+        layers,
+        tensor,
+        async_op,
+        lambda: torch.distributed.all_reduce(tensor, async_op=async_op),
+    )
+
+
+def all_gather(
+    tensor_list: List[torch.Tensor],
+    tensor: torch.Tensor,
+    log: Optional[CommunicationLog] = None,
+    phase: str = "",
+    layers: Optional[Dict[Any, int]] = None,
+    async_op: bool = False,
+):
+    """torch.distributed.all_gather, recorded in `log` if it is given"""
+    if log is None:
+        return torch.distributed.all_gather(tensor_list, tensor, async_op=async_op)
+    num_bytes = tensor.nelement() * tensor.element_size()
+    return _logged(
+        log,
+        "all_gather",
+        phase,
+        num_bytes,
+        layers,
+        tensor,
+        async_op,
+        lambda: torch.distributed.all_gather(tensor_list, tensor, async_op=async_op),
+    )
+
+
+class LoggedWork:
+    """An asynchronous collective, that is recorded when it is waited for"""
+
+    def __init__(
+        self, work, log: CommunicationLog, record: Dict[str, Any], tensor, start: float
+    ):
+        self._work = work
+        self._log = log
+        self._record = record
+        self._tensor = tensor
+        self._start = start
+
+    def wait(self):
+        result = self._work.wait()
+        if self._record is not None:
+            self._log._synchronize(self._tensor)
+            self._log.record(**self._record, seconds=time.perf_counter() - self._start)
+            self._record = None
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._work, name)
+
+
+def _logged(log, collective, phase, num_bytes, layers, tensor, async_op, run):
+    log._synchronize(tensor)
+    start = time.perf_counter()
+    work = run()
+    if async_op:
+        record = dict(
+            collective=collective, phase=phase, num_bytes=num_bytes, layers=layers
+        )
+        return LoggedWork(work, log, record, tensor, start)
+    log._synchronize(tensor)
+    log.record(collective, phase, num_bytes, time.perf_counter() - start, layers)
+    return work
+
+
+def _bytes_sent(collective: str, num_bytes: int) -> float:
+    if (
+        torch.distributed.is_available()  # type: ignore
+        and torch.distributed.is_initialized()  # type: ignore
+    ):
+        num_workers = torch.distributed.get_world_size()  # type: ignore
+    else:
+        num_workers = 1
+    if collective == "all_reduce":
+        return 2 * (num_workers - 1) / num_workers * num_bytes
+    elif collective == "all_gather":
+        return (num_workers - 1) * num_bytes
+    else:
+        return num_bytes
@@ -0,0 +1,135 @@
+from typing import Any, Dict, List, Optional
+
+import torch
+
+LOW_PRECISION_DTYPES = {"bfloat16": torch.bfloat16, "float16": torch.float16}
+MANTISSA_BITS = {torch.bfloat16: 8, torch.float16: 11}
+# Below this exponent, numbers are subnormal
+MIN_EXPONENT = {torch.bfloat16: -125, torch.float16: -13}
+
+
+class ErrorFeedbackBuffer:
+    """
+    Stores the error feedback of a list of tensors in low precision,
+    as "bfloat16", "float16" or blockwise-scaled "int8".
+    Rounding is stochastic, so the stored error is unbiased.
+    """
+
+    def __init__(
+        self,
+        tensors: List[torch.Tensor],
+        dtype: str,
+        block_size: int = 256,
+        seed: int = 0,
+    ):
+        if dtype != "int8" and dtype not in LOW_PRECISION_DTYPES:
+            raise ValueError(f"Unsupported error feedback dtype {dtype}")
+        self.dtype = dtype
+        self.block_size = block_size
+        self._generators = {}
+        self._seed = seed
+
+        if dtype == "int8":
+            num_blocks = [-(-t.nelement() // block_size) for t in tensors]
+            self._values = [
+                torch.zeros(n * block_size, dtype=torch.int8, device=t.device)
+                for n, t in zip(num_blocks, tensors)
+            ]
+            self._scales = [
+                torch.zeros(n, dtype=torch.float32, device=t.device)
+                for n, t in zip(num_blocks, tensors)
+            ]
+        else:
+            self._values = [
+                torch.zeros_like(t, dtype=LOW_PRECISION_DTYPES[dtype]) for t in tensors
+            ]
+
+    def add_to(
+        self, tensors: List[torch.Tensor], out: Optional[List[torch.Tensor]] = None
+    ):
+        """Add the stored error to `tensors`, in place or into `out`"""
+        if out is None:
+            out = tensors
+        for i, (tensor, result) in enumerate(zip(tensors, out)):
+            if self.dtype == "int8":
+                blocks = self._values[i].view(-1, self.block_size).to(tensor.dtype)
+                blocks.mul_(self._scales[i][:, None])
+                error = blocks.view(-1)[: tensor.nelement()].view_as(tensor)
+            else:
+                error = self._values[i]
+            torch.add(tensor, error, out=result)
+
+    def store(self, tensors: List[torch.Tensor]):
+        """Replace the stored error by `tensors`, with stochastic rounding"""
+        for i, tensor in enumerate(tensors):
+            generator = self._generator(tensor.device)
+            if self.dtype == "int8":
+                blocks = tensor.new_zeros(self._values[i].shape)
+                blocks[: tensor.nelement()] = tensor.reshape(-1)
+                blocks = blocks.view(-1, self.block_size)
+                scales = self._scales[i]
+                scales.copy_(blocks.abs().amax(dim=1))
+                scales.div_(127).clamp_(min=torch.finfo(torch.float32).tiny)
+                blocks.div_(scales[:, None].to(blocks.dtype))
+                noise = torch.rand(
+                    blocks.shape, generator=generator, device=blocks.device
+                )
+                blocks.add_(noise).floor_().clamp_(-127, 127)
+                self._values[i].copy_(blocks.view(-1))
+            else:
+                stochastic_round(tensor, out=self._values[i], generator=generator)
+
+    def state_dict(self) -> Dict[str, Any]:
+        """The stored error and the state of the rounding noise, for checkpoints"""
+        return {
+            "values": self._values,
+            "scales": self._scales if self.dtype == "int8" else None,
+            "generators": {
+                str(device): generator.get_state()
+                for device, generator in self._generators.items()
+            },
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        for values, stored in zip(self._values, state["values"]):
+            values.copy_(stored)
+        if self.dtype == "int8":
+            for scales, stored in zip(self._scales, state["scales"]):
+                scales.copy_(stored)
+        for device, generator_state in state["generators"].items():
+            self._generator(torch.device(device)).set_state(generator_state.cpu())
+
+    def _generator(self, device: torch.device) -> torch.Generator:
+        if device not in self._generators:
+            self._generators[device] = torch.Generator(device=device).manual_seed(
+                self._seed
+            )
+        return self._generators[device]
+
+
+def stochastic_round(
+    tensor: torch.Tensor,
+    out: torch.Tensor,
+    generator: Optional[torch.Generator] = None,
+) -> torch.Tensor:
+    """
+    Round `tensor` to the (bfloat16 or float16) precision of `out`, up or down with
+    a probability proportional to the distance, so the result is unbiased.
+    """
+    _, exponent = torch.frexp(tensor)
+    min_exponent = MIN_EXPONENT[out.dtype]
+    exponent = torch.where(
+        tensor == 0, torch.full_like(exponent, min_exponent), exponent
+    )
+    exponent.clamp_(min=min_exponent).sub_(MANTISSA_BITS[out.dtype])
+    ulp = torch.exp2(exponent.to(tensor.dtype))
+
+    # Both neighbours are multiples of the ulp, so dividing and rounding is exact.
+    # Rounding to nearest after adding noise would not be: near a power of two,
+    # the noise can cross into the binade below, where the ulp is smaller.
+    scaled = tensor / ulp
+    down = torch.floor(scaled)
+    noise = torch.rand(tensor.shape, generator=generator, device=tensor.device)
+    # Round up with a probability equal to the distance from the value below
+    round_up = noise < scaled.sub_(down)
+    return out.copy_(down.add_(round_up.to(down.dtype)).mul_(ulp))
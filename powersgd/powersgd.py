@@ -1,14 +1,25 @@
 from abc import ABC, abstractmethod
 from collections import defaultdict
-from typing import Dict, List, NamedTuple, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Union
 
 import torch
 
+from powersgd.communication import CommunicationLog, all_reduce
+from powersgd.error_feedback import ErrorFeedbackBuffer
 from powersgd.orthogonalization import orthogonalize
 from powersgd.utils import allreduce_average, pack, unpack, is_distributed
 
 
 class Aggregator(ABC):
+    # True if the aggregator keeps compression errors itself,
+    # instead of in its input gradients
+    stores_error_feedback = False
+    # True if the last call to `aggregate` did not communicate and left its input
+    # gradients to accumulate until the next call, so no optimizer step should be taken
+    accumulating = False
+    # Counts the bytes that `aggregate` communicates, if it is set
+    communication: Optional[CommunicationLog] = None
+
     @abstractmethod
     def aggregate(self, gradients: List[torch.Tensor]) -> List[torch.Tensor]:
         """
@@ -20,11 +31,26 @@ class Aggregator(ABC):
 
 
 class AllReduce(Aggregator):
+    def __init__(self, layer_ids: Optional[List[Any]] = None):
+        # How the gradients are called in the communication log, their index by default
+        self.layer_ids = layer_ids
+
     def aggregate(self, gradients: List[torch.Tensor]) -> List[torch.Tensor]:
         if len(gradients) == 0:
             return []
         buffer, shapes = pack(gradients)
-        allreduce_average(buffer)
+        layers = None
+        if self.communication is not None:
+            layer_ids = (
+                self.layer_ids if self.layer_ids is not None else range(len(gradients))
+            )
+            layers = {
+                layer: g.nelement() * g.element_size()
+                for layer, g in zip(layer_ids, gradients)
+            }
+        allreduce_average(
+            buffer, self.communication, phase="uncompressed", layers=layers
+        )
         out = unpack(buffer, shapes)
         for g in gradients:
             g.zero_()
@@ -36,6 +62,12 @@ class Config(NamedTuple):
     min_compression_rate: float = 2  # skip compression on some gradients
     num_iters_per_step: int = 1  # lower number => more aggressive compression
     start_compressing_after_num_steps: int = 100
+    # "bfloat16", "float16" or "int8" to save memory
+    error_feedback_dtype: Optional[str] = None
+    # Only communicate on every n'th call to `aggregate`
+    communication_interval: int = 1
+    # In between, return local gradients instead of accumulating
+    local_updates: bool = False
 
 
 class PowerSGD(Aggregator):
@@ -49,30 +81,120 @@ class PowerSGD(Aggregator):
         self.device = list(params)[0].device
         self.is_compressed_mask = [self._should_compress(p.shape) for p in params]
 
-        self.step_counter = 0
+        self.step_counter = 0  # number of communication rounds
+        self.call_counter = 0
 
         compressed_params, _ = self._split(params)
+        compressed_ids, uncompressed_ids = self._split(
+            list(range(len(self.is_compressed_mask)))
+        )
         self._powersgd = BasicPowerSGD(
             compressed_params,
             config=BasicConfig(
                 rank=config.rank,
                 num_iters_per_step=config.num_iters_per_step,
             ),
+            layer_ids=compressed_ids,
         )
-        self._allreduce = AllReduce()
+        self._allreduce = AllReduce(layer_ids=uncompressed_ids)
+        # For all gradients, before compression starts
+        self._warmup_allreduce = AllReduce()
+        self.communication = None
+
+        # Optionally keep the compression errors in low-precision storage
+        # rather than in full precision in the input gradients
+        self._error_feedback: Optional[ErrorFeedbackBuffer] = None
+        if config.error_feedback_dtype is not None:
+            self._error_feedback = ErrorFeedbackBuffer(
+                compressed_params, config.error_feedback_dtype
+            )
+            self.stores_error_feedback = True
+
+        # With local updates, the sum of local gradients applied
+        # since the last communication round
+        self._applied_locally: Optional[List[torch.Tensor]] = None
+        self._zeros: Optional[List[torch.Tensor]] = None
 
     def aggregate(self, gradients: List[torch.Tensor]) -> List[torch.Tensor]:
+        """
+        With a `communication_interval` > 1, only every n'th call communicates.
+        In between, the gradients either keep accumulating in the input tensors
+        (and the returned update is zero), or, with `local_updates`, the local
+        gradients are returned and undone again in the next communication round.
+        For plain SGD, this brings all workers back to the same parameters.
+        """
+        self.call_counter += 1
+        if self.call_counter % self.config.communication_interval != 0:
+            return self._skip_communication(gradients)
+
+        self.accumulating = False
         self.step_counter += 1
 
+        if self._applied_locally is not None:
+            # Communicate everything since the last round,
+            # including what was applied locally
+            for g, applied in zip(gradients, self._applied_locally):
+                g.add_(applied)
+
+        avg_grads = self._communicate(gradients)
+
+        if self._applied_locally is not None:
+            # Replace the local updates by the average, so all workers agree again
+            for avg, applied in zip(avg_grads, self._applied_locally):
+                avg.sub_(applied)
+                applied.zero_()
+
+        return avg_grads
+
+    @property
+    def communication(self) -> Optional[CommunicationLog]:
+        """
+        Set a CommunicationLog to count the communication of all rounds,
+        layers are indices into `params`. Nothing is counted by default.
+        """
+        return self._communication
+
+    @communication.setter
+    def communication(self, log: Optional[CommunicationLog]):
+        self._communication = log
+        for aggregator in [self._powersgd, self._allreduce, self._warmup_allreduce]:
+            aggregator.communication = log
+
+    def _skip_communication(self, gradients: List[torch.Tensor]) -> List[torch.Tensor]:
+        if not self.config.local_updates:
+            self.accumulating = True
+            if self._zeros is None:
+                self._zeros = [torch.zeros_like(g) for g in gradients]
+            return self._zeros
+
+        if self._applied_locally is None:
+            self._applied_locally = [torch.zeros_like(g) for g in gradients]
+        local_grads = [g.clone() for g in gradients]
+        for g, applied in zip(gradients, self._applied_locally):
+            applied.add_(g)
+            g.zero_()
+        return local_grads
+
+    def _communicate(self, gradients: List[torch.Tensor]) -> List[torch.Tensor]:
         if self.step_counter <= self.config.start_compressing_after_num_steps:
-            return self._allreduce.aggregate(gradients)
+            return self._warmup_allreduce.aggregate(gradients)
 
         compressed_grads, uncompressed_grads = self._split(gradients)
-        return self._merge(
+        if self._error_feedback is not None:
+            self._error_feedback.add_to(compressed_grads)
+
+        avg_grads = self._merge(
             self._powersgd.aggregate(compressed_grads),
             self._allreduce.aggregate(uncompressed_grads),
         )
 
+        if self._error_feedback is not None:
+            self._error_feedback.store(compressed_grads)
+            for g in compressed_grads:
+                g.zero_()
+
+        return avg_grads
+
     def _split(self, params: List[torch.Tensor]):
         compressed_params = []
         uncompressed_params = []
@@ -111,7 +233,12 @@ class BasicConfig(NamedTuple):
 
 
 class BasicPowerSGD(Aggregator):
-    def __init__(self, params: List[torch.Tensor], config: BasicConfig):
+    def __init__(
+        self,
+        params: List[torch.Tensor],
+        config: BasicConfig,
+        layer_ids: Optional[List[Any]] = None,
+    ):
         # Configuration
         self.config = config
         self.params = list(params)
@@ -143,6 +270,17 @@ class BasicPowerSGD(Aggregator):
         )
         self._qs = unpack(self._qs_buffer, qs_shapes)
 
+        # Bytes of every parameter in the all-reduced p's and q's,
+        # for the communication log
+        if layer_ids is None:
+            layer_ids = list(range(len(self.params)))
+        self._layer_bytes: Dict[str, Dict[Any, int]] = {"p": {}, "q": {}}
+        for layer, param in zip(layer_ids, self.params):
+            n, m = view_as_matrix(param).shape
+            rank = min(self.config.rank, n, m)
+            self._layer_bytes["p"][layer] = n * rank * self._ps_buffer.element_size()
+            self._layer_bytes["q"][layer] = m * rank * self._qs_buffer.element_size()
+
     def aggregate(self, gradients: List[torch.Tensor]) -> List[torch.Tensor]:
         """
         Create a low-rank approximation of the average gradients by communicating with other workers.
@@ -176,10 +314,12 @@ class BasicPowerSGD(Aggregator):
                 maybe_transpose = lambda g: g
                 out_batches, in_batches = self._qs, self._ps
                 out_buffer = self._qs_buffer
+                phase = "q"
             else:
                 maybe_transpose = batch_transpose
                 out_batches, in_batches = self._ps, self._qs
                 out_buffer = self._ps_buffer
+                phase = "p"
 
             # Matrix multiplication
             for group, in_batch, out_batch in zip(
@@ -204,7 +344,12 @@ class BasicPowerSGD(Aggregator):
             # Average across workers
             if is_distributed():
                 num_workers = torch.distributed.get_world_size()
-                torch.distributed.all_reduce(out_buffer)
+                all_reduce(
+                    out_buffer,
+                    self.communication,
+                    phase="powersgd." + phase,
+                    layers=self._layer_bytes[phase],
+                )
             else:
                 num_workers = 1
 
@@ -2,6 +2,8 @@ from typing import List, Tuple
 import torch
 from types import SimpleNamespace
 
+from powersgd.communication import all_reduce
+
 
 def pack(tensors: List[torch.Tensor]) -> Tuple[torch.Tensor, List[torch.Size]]:
     """Packs a list of tensors into one buffer for sending to other workers"""
@@ -41,9 +43,13 @@ def flatten(tensors: List[List[torch.Tensor]]) -> List[torch.Tensor]:
 
 
 def allreduce_average(data, *args, **kwargs):
-    """All-reduce average if torch.distributed is available, otherwise do nothing"""
+    """
+    All-reduce average if torch.distributed is available, otherwise do nothing.
+    Takes the arguments of `powersgd.communication.all_reduce`,
+    to record the communication.
+    """
     if is_distributed():
         data.div_(torch.distributed.get_world_size())  # type: ignore
-        return torch.distributed.all_reduce(data, *args, **kwargs)  # type: ignore
+        return all_reduce(data, *args, **kwargs)
     else:
         return SimpleNamespace(wait=lambda: None)
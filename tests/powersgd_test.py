@@ -1,6 +1,18 @@
+import pytest
 import torch
 
-from powersgd import PowerSGD, Config
+from powersgd import PowerSGD, Config, optimizer_step
+from powersgd.communication import CommunicationLog
+from powersgd.error_feedback import ErrorFeedbackBuffer, stochastic_round
+
+
+@pytest.fixture(autouse=True)
+def restore_default_dtype():
+    """Some tests switch to float64, this keeps it from leaking into the next tests"""
+    default_dtype = torch.get_default_dtype()
+    yield
+    torch.set_default_dtype(default_dtype)
+
 
 def build_model():
     return torch.nn.Sequential(
@@ -55,5 +67,198 @@ def test_error_feedback_mechanism():
         assert orig.allclose(avg + buffer)
 
 
+def test_stochastic_rounding_is_unbiased():
+    value = 1 + 2**-10  # in between two bfloat16 numbers
+    tensor = torch.full([100_000], value, dtype=torch.float32)
+    rounded = torch.empty_like(tensor, dtype=torch.bfloat16)
+    stochastic_round(tensor, out=rounded, generator=torch.Generator().manual_seed(0))
+
+    assert set(rounded.float().unique().tolist()) == {1.0, 1 + 2**-7}
+    assert abs(rounded.double().mean().item() - value) < 1e-4
+
+
+def test_low_precision_error_feedback():
+    model = build_model()
+    params = list(model.parameters())
+    for dtype in ["bfloat16", "float16", "int8"]:
+        config = Config(
+            rank=2,
+            min_compression_rate=10,
+            start_compressing_after_num_steps=0,
+            num_iters_per_step=3,
+            error_feedback_dtype=dtype,
+        )
+        powersgd = PowerSGD(list(params), config=config)
+
+        gradients = [torch.randn_like(p) for p in params]
+        grad_orig = [g.clone() for g in gradients]
+        avg_grad = powersgd.aggregate(gradients)
+
+        for grad in gradients:
+            assert grad.allclose(torch.zeros_like(grad))
+
+        compressed_orig, _ = powersgd._split(grad_orig)
+        compressed_avg, _ = powersgd._split(avg_grad)
+        errors = [torch.zeros_like(g) for g in compressed_orig]
+        powersgd._error_feedback.add_to(errors)
+        for orig, avg, error in zip(compressed_orig, compressed_avg, errors):
+            assert orig.allclose(avg + error, atol=0.05)
+
+
+def test_low_precision_error_feedback_converges():
+    """A least-squares problem that needs error feedback to be solved with rank 1"""
+    torch.manual_seed(0)
+    inputs = torch.randn(200, 40)
+    targets = inputs @ torch.randn(40, 30)
+
+    final_losses = {}
+    for dtype in [None, "bfloat16", "float16", "int8"]:
+        weight = torch.zeros(40, 30, requires_grad=True)
+        optimizer = torch.optim.SGD([weight], lr=0.3)
+        config = Config(
+            rank=1,
+            min_compression_rate=2,
+            start_compressing_after_num_steps=0,
+            error_feedback_dtype=dtype,
+        )
+        powersgd = PowerSGD([weight], config=config)
+        for _ in range(300):
+            loss = torch.nn.functional.mse_loss(inputs @ weight, targets)
+            loss.backward()
+            optimizer_step(optimizer, powersgd)
+        final_losses[dtype] = loss.item()
+
+    initial_loss = targets.pow(2).mean().item()
+    assert final_losses[None] < 0.01 * initial_loss
+    for dtype, loss in final_losses.items():
+        assert loss < 2 * final_losses[None] + 1e-3 * initial_loss
+
+
+def test_error_feedback_buffer_state_dict():
+    tensors = [torch.randn(10, 30), torch.randn(7)]
+    for dtype in ["bfloat16", "int8"]:
+        buffer = ErrorFeedbackBuffer(tensors, dtype, seed=1)
+        buffer.store(tensors)
+        restored = ErrorFeedbackBuffer(tensors, dtype, seed=2)
+        restored.load_state_dict(buffer.state_dict())
+
+        for target in [buffer, restored]:
+            target.store([2 * t for t in tensors])  # uses the restored rounding noise
+        expected = [torch.zeros_like(t) for t in tensors]
+        actual = [torch.zeros_like(t) for t in tensors]
+        buffer.add_to(expected)
+        restored.add_to(actual)
+        for e, a in zip(expected, actual):
+            assert torch.equal(e, a)
+
+
+def test_communication_log(tmp_path):
+    torch.distributed.init_process_group(
+        "gloo", init_method=f"file://{tmp_path}/store", world_size=1, rank=0
+    )
+    try:
+        model = build_model()
+        params = list(model.parameters())
+        config = Config(
+            rank=2,
+            min_compression_rate=10,
+            start_compressing_after_num_steps=1,
+            num_iters_per_step=1,
+        )
+        powersgd = PowerSGD(list(params), config=config)
+        powersgd.communication = CommunicationLog()
+        for _ in range(3):
+            powersgd.aggregate([torch.randn_like(p) for p in params])
+    finally:
+        torch.distributed.destroy_process_group()
+
+    # One uncompressed step, then two steps that all-reduce q and p
+    counters = powersgd.communication.counters
+    assert counters[("all_reduce", "uncompressed")]["calls"] == 3
+    assert counters[("all_reduce", "powersgd.q")]["calls"] == 1
+    assert counters[("all_reduce", "powersgd.p")]["calls"] == 1
+    num_bytes = sum(p.nelement() * p.element_size() for p in params)
+    _, uncompressed = powersgd._split(params)
+    num_uncompressed_bytes = sum(p.nelement() * p.element_size() for p in uncompressed)
+    layer_bytes = powersgd._powersgd._layer_bytes
+    num_compressed_bytes = sum(layer_bytes["p"].values()) + sum(
+        layer_bytes["q"].values()
+    )
+    assert powersgd.communication.total_bytes == (
+        num_bytes + 2 * num_uncompressed_bytes + num_compressed_bytes
+    )
+    for phase, layer in powersgd.communication.layer_bytes:
+        if phase.startswith("powersgd"):
+            assert powersgd.is_compressed_mask[layer]
+
+
+def test_gradient_accumulation():
+    torch.set_default_dtype(torch.float64)
+    model = build_model()
+    params = list(model.parameters())
+    config = Config(
+        rank=2,
+        min_compression_rate=10,
+        start_compressing_after_num_steps=0,
+        num_iters_per_step=3,
+    )
+    powersgd = PowerSGD(list(params), config=config._replace(communication_interval=3))
+    reference = PowerSGD(list(params), config=config)
+
+    gradients = [torch.zeros_like(p) for p in params]
+    grad_sum = [torch.zeros_like(p) for p in params]
+    for step in range(3):
+        micro_batch_grads = [torch.randn_like(p) for p in params]
+        for g, s, micro in zip(gradients, grad_sum, micro_batch_grads):
+            g.add_(micro)
+            s.add_(micro)
+        avg_grad = powersgd.aggregate(gradients)
+        assert powersgd.accumulating == (step < 2)
+
+    assert powersgd.step_counter == 1
+    reference_avg_grad = reference.aggregate(grad_sum)
+    for avg, ref, buffer, ref_buffer in zip(
+        avg_grad, reference_avg_grad, gradients, grad_sum
+    ):
+        assert avg.allclose(ref)
+        assert buffer.allclose(ref_buffer)
+
+
+def test_local_updates():
+    torch.set_default_dtype(torch.float64)
+    model = build_model()
+    params = list(model.parameters())
+    config = Config(
+        rank=2,
+        min_compression_rate=10,
+        start_compressing_after_num_steps=0,
+        num_iters_per_step=3,
+    )
+    powersgd = PowerSGD(
+        list(params),
+        config=config._replace(communication_interval=2, local_updates=True),
+    )
+    reference = PowerSGD(list(params), config=config)
+
+    local_grads = [torch.randn_like(p) for p in params]
+    gradients = [g.clone() for g in local_grads]
+    local_update = powersgd.aggregate(gradients)
+    for update, orig in zip(local_update, local_grads):
+        assert update.allclose(orig)
+
+    next_grads = [torch.randn_like(p) for p in params]
+    gradients = [g.clone() for g in next_grads]
+    correction = powersgd.aggregate(gradients)
+
+    # The local update plus the correction equal one communication round on the sum
+    grad_sum = [a + b for a, b in zip(local_grads, next_grads)]
+    reference_avg_grad = reference.aggregate(grad_sum)
+    for update, corr, ref, buffer, ref_buffer in zip(
+        local_update, correction, reference_avg_grad, gradients, grad_sum
+    ):
+        assert (update + corr).allclose(ref)
+        assert buffer.allclose(ref_buffer)
+
+
 if __name__ == "__main__":
     test_error_feedback_mechanism(model())